@@ -1,8 +1,11 @@
 import base64
 import hashlib
 import hmac
+import itertools
 import json
+import threading
 import time
+from collections import OrderedDict
 from flask import Flask, abort, request
 from uuid import uuid4
 
@@ -10,7 +13,12 @@ app = Flask(__name__)
 books = {}
 loans = {}
 users = {"admin": {"password": "admin"}}
+collection_versions = {"books": 0, "loans": 0}
+version_sequence = itertools.count(1)
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
 SECRET = "change-me"
+RESPONSE_CACHE_SIZE = 512
 
 def b64url_encode(data):
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
@@ -62,9 +70,32 @@ def json_response(data, status=200, cache_control="no-store"):
     response.headers["Cache-Control"] = cache_control
     return response
 
-def cached_json(data, max_age=60):
-    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
-    etag = hashlib.sha256(body.encode()).hexdigest()
+def invalidate_cached_responses(collection):
+    collection_versions[collection] = next(version_sequence)
+
+def cached_json(build, depends_on, max_age=60):
+    """Serve a GET body and ETag from the response cache until a ``depends_on`` collection changes.
+
+    ``build`` is only called on a miss, so a conditional GET that hits the cache is answered
+    without rebuilding or hashing the payload.
+    """
+    key = request.full_path
+    version = tuple(collection_versions[collection] for collection in depends_on)
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is not None and entry[0] == version:
+            response_cache.move_to_end(key)
+        else:
+            entry = None
+    if entry is None:
+        body = json.dumps(build(), separators=(",", ":"), sort_keys=True).encode()
+        entry = (version, body, hashlib.sha256(body).hexdigest())
+        with response_cache_lock:
+            response_cache[key] = entry
+            response_cache.move_to_end(key)
+            while len(response_cache) > RESPONSE_CACHE_SIZE:
+                response_cache.popitem(last=False)
+    _, body, etag = entry
     if request.headers.get("If-None-Match") == etag:
         response = app.response_class(status=304)
         response.headers["Cache-Control"] = f"private, max-age={max_age}"
@@ -100,7 +131,7 @@ def login():
 @app.route("/books", methods=["GET"])
 def list_books():
     authenticate_request()
-    return cached_json(list(books.values()))
+    return cached_json(lambda: list(books.values()), ("books",))
 
 @app.route("/books", methods=["POST"])
 def create_book():
@@ -110,12 +141,14 @@ def create_book():
     book_id = str(uuid4())
     book = {"id": book_id, "title": payload["title"], "author": payload["author"]}
     books[book_id] = book
+    invalidate_cached_responses("books")
     return json_response(book, status=201)
 
 @app.route("/books/<book_id>", methods=["GET"])
 def retrieve_book(book_id):
     authenticate_request()
-    return cached_json(get_book_or_404(book_id))
+    book = get_book_or_404(book_id)
+    return cached_json(lambda: book, ("books",))
 
 @app.route("/books/<book_id>", methods=["PUT"])
 def update_book(book_id):
@@ -124,6 +157,7 @@ def update_book(book_id):
     require_fields(payload, ["title", "author"])
     book = get_book_or_404(book_id)
     book.update({"title": payload["title"], "author": payload["author"]})
+    invalidate_cached_responses("books")
     return json_response(book)
 
 @app.route("/books/<book_id>", methods=["DELETE"])
@@ -131,6 +165,7 @@ def delete_book(book_id):
     authenticate_request()
     get_book_or_404(book_id)
     books.pop(book_id)
+    invalidate_cached_responses("books")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -138,7 +173,7 @@ def delete_book(book_id):
 @app.route("/loans", methods=["GET"])
 def list_loans():
     authenticate_request()
-    return cached_json(list(loans.values()))
+    return cached_json(lambda: list(loans.values()), ("loans",))
 
 @app.route("/loans", methods=["POST"])
 def create_loan():
@@ -150,12 +185,14 @@ def create_loan():
     loan_id = str(uuid4())
     loan = {"id": loan_id, "book_id": payload["book_id"], "borrower": payload["borrower"]}
     loans[loan_id] = loan
+    invalidate_cached_responses("loans")
     return json_response(loan, status=201)
 
 @app.route("/loans/<loan_id>", methods=["GET"])
 def retrieve_loan(loan_id):
     authenticate_request()
-    return cached_json(get_loan_or_404(loan_id))
+    loan = get_loan_or_404(loan_id)
+    return cached_json(lambda: loan, ("loans",))
 
 @app.route("/loans/<loan_id>", methods=["PUT"])
 def update_loan(loan_id):
@@ -166,6 +203,7 @@ def update_loan(loan_id):
         abort(404, description="Book not found")
     loan = get_loan_or_404(loan_id)
     loan.update({"book_id": payload["book_id"], "borrower": payload["borrower"]})
+    invalidate_cached_responses("loans")
     return json_response(loan)
 
 @app.route("/loans/<loan_id>", methods=["DELETE"])
@@ -173,6 +211,7 @@ def delete_loan(loan_id):
     authenticate_request()
     get_loan_or_404(loan_id)
     loans.pop(loan_id)
+    invalidate_cached_responses("loans")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -1,8 +1,12 @@
 import base64
+import functools
 import hashlib
 import hmac
+import itertools
 import json
+import threading
 import time
+from collections import OrderedDict
 from flask import Flask, abort, request, url_for
 from uuid import uuid4
 
@@ -10,7 +14,13 @@ app = Flask(__name__)
 books = {}
 loans = {}
 users = {"admin": {"password": "admin"}}
+collection_versions = {"books": 0, "loans": 0}
+version_sequence = itertools.count(1)
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
 SECRET = "change-me"
+TOKEN_CACHE_SIZE = 1024
+RESPONSE_CACHE_SIZE = 512
 
 def b64url_encode(data):
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
@@ -28,7 +38,8 @@ def encode_jwt(payload):
     signature_b64 = b64url_encode(signature)
     return f"{header_b64}.{payload_b64}.{signature_b64}"
 
-def decode_jwt(token):
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def verify_jwt(token):
     try:
         header_b64, payload_b64, signature_b64 = token.split(".")
     except ValueError:
@@ -38,7 +49,11 @@ def decode_jwt(token):
     provided_signature = b64url_decode(signature_b64)
     if not hmac.compare_digest(provided_signature, expected_signature):
         abort(401, description="Invalid token")
-    payload = json.loads(b64url_decode(payload_b64))
+    return json.loads(b64url_decode(payload_b64))
+
+def decode_jwt(token):
+    # Signature checks are cached per token string; expiry is still enforced on every call.
+    payload = verify_jwt(token)
     if "exp" in payload and time.time() > payload["exp"]:
         abort(401, description="Token expired")
     return payload
@@ -65,9 +80,32 @@ def json_response(data, status=200, cache_control="no-store", headers=None):
             response.headers[key] = value
     return response
 
-def cached_response(data, max_age=60):
-    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
-    etag = hashlib.sha256(body.encode()).hexdigest()
+def invalidate_cached_responses(collection):
+    collection_versions[collection] = next(version_sequence)
+
+def cached_response(build, depends_on, max_age=60):
+    """Serve a GET body and ETag from the response cache until a ``depends_on`` collection changes.
+
+    ``build`` is only called on a miss, so a conditional GET that hits the cache is answered
+    without rebuilding or hashing the payload.
+    """
+    key = request.full_path
+    version = tuple(collection_versions[collection] for collection in depends_on)
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is not None and entry[0] == version:
+            response_cache.move_to_end(key)
+        else:
+            entry = None
+    if entry is None:
+        body = json.dumps(build(), separators=(",", ":"), sort_keys=True).encode()
+        entry = (version, body, hashlib.sha256(body).hexdigest())
+        with response_cache_lock:
+            response_cache[key] = entry
+            response_cache.move_to_end(key)
+            while len(response_cache) > RESPONSE_CACHE_SIZE:
+                response_cache.popitem(last=False)
+    _, body, etag = entry
     if request.headers.get("If-None-Match") == etag:
         response = app.response_class(status=304)
     else:
@@ -76,8 +114,10 @@ def cached_response(data, max_age=60):
     response.headers["ETag"] = etag
     return response
 
-def envelope(data, links=None, meta=None):
+def envelope(data, links=None, meta=None, included=None):
     payload = {"data": data}
+    if included is not None:
+        payload["included"] = included
     if links:
         payload["links"] = links
     if meta:
@@ -120,6 +160,54 @@ def loan_resource(loan):
         }
     }
 
+LOAN_INCLUDES = {"book"}
+
+def include_param(allowed):
+    names = {name.strip() for name in request.args.get("include", "").split(",") if name.strip()}
+    unknown = names - allowed
+    if unknown:
+        abort(400, description="Unsupported include: " + ", ".join(sorted(unknown)))
+    return names
+
+def sparse_fields():
+    """Read JSON:API ``fields[<type>]=a,b`` parameters into a mapping of type to field names."""
+    fields = {}
+    for key, value in request.args.items():
+        if key.startswith("fields[") and key.endswith("]"):
+            fields[key[len("fields["):-1]] = {name.strip() for name in value.split(",") if name.strip()}
+    return fields
+
+def compound_params():
+    return {key: value for key, value in request.args.items() if key == "include" or key.startswith("fields[")}
+
+def sparse_fieldset(resource, fields):
+    wanted = fields.get(resource["type"])
+    if wanted is None:
+        return resource
+    resource["attributes"] = {name: value for name, value in resource["attributes"].items() if name in wanted}
+    if "relationships" in resource:
+        resource["relationships"] = {name: value for name, value in resource["relationships"].items() if name in wanted}
+    return resource
+
+class IncludedBooks:
+    """Collects the distinct books referenced by a set of loans for a compound document."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.book_ids = {}
+
+    def add(self, loan):
+        self.book_ids.setdefault(loan["book_id"], None)
+
+    def resources(self):
+        found = (books.get(book_id) for book_id in self.book_ids)
+        return [sparse_fieldset(book_resource(book), self.fields) for book in found if book]
+
+def loan_document_resource(loan, fields, included=None):
+    if included is not None:
+        included.add(loan)
+    return sparse_fieldset(loan_resource(loan), fields)
+
 @app.route("/auth/login", methods=["POST"])
 def login():
     payload = request.get_json(force=True)
@@ -133,9 +221,12 @@ def login():
 @app.route("/books", methods=["GET"])
 def list_books():
     authenticate_request()
-    resources = [book_resource(book) for book in books.values()]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_books")}, meta=meta))
+
+    def build():
+        resources = [book_resource(book) for book in books.values()]
+        meta = {"count": len(resources)}
+        return envelope(resources, links={"self": url_for("list_books")}, meta=meta)
+    return cached_response(build, ("books",))
 
 @app.route("/books", methods=["POST"])
 def create_book():
@@ -145,6 +236,7 @@ def create_book():
     book_id = str(uuid4())
     book = {"id": book_id, "title": payload["title"], "author": payload["author"]}
     books[book_id] = book
+    invalidate_cached_responses("books")
     resource = book_resource(book)
     location = resource["links"]["self"]
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
@@ -155,8 +247,11 @@ def retrieve_book(book_id):
     book = books.get(book_id)
     if not book:
         abort(404, description="Book not found")
-    resource = book_resource(book)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+
+    def build():
+        resource = book_resource(book)
+        return envelope(resource, links={"self": resource["links"]["self"]})
+    return cached_response(build, ("books",))
 
 @app.route("/books/<book_id>", methods=["PUT"])
 def update_book(book_id):
@@ -167,6 +262,7 @@ def update_book(book_id):
     if not book:
         abort(404, description="Book not found")
     book.update({"title": payload["title"], "author": payload["author"]})
+    invalidate_cached_responses("books")
     resource = book_resource(book)
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
 
@@ -176,6 +272,7 @@ def delete_book(book_id):
     if book_id not in books:
         abort(404, description="Book not found")
     books.pop(book_id)
+    invalidate_cached_responses("books")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -183,9 +280,16 @@ def delete_book(book_id):
 @app.route("/loans", methods=["GET"])
 def list_loans():
     authenticate_request()
-    resources = [loan_resource(loan) for loan in loans.values()]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_loans")}, meta=meta))
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        resources = [loan_document_resource(loan, fields, included) for loan in loans.values()]
+        meta = {"count": len(resources)}
+        links = {"self": url_for("list_loans", **compound_params())}
+        return envelope(resources, links=links, meta=meta, included=included and included.resources())
+    return cached_response(build, ("loans", "books") if include else ("loans",))
 
 @app.route("/loans", methods=["POST"])
 def create_loan():
@@ -197,6 +301,7 @@ def create_loan():
     loan_id = str(uuid4())
     loan = {"id": loan_id, "book_id": payload["book_id"], "borrower": payload["borrower"]}
     loans[loan_id] = loan
+    invalidate_cached_responses("loans")
     resource = loan_resource(loan)
     location = resource["links"]["self"]
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
@@ -207,8 +312,15 @@ def retrieve_loan(loan_id):
     loan = loans.get(loan_id)
     if not loan:
         abort(404, description="Loan not found")
-    resource = loan_resource(loan)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        resource = loan_document_resource(loan, fields, included)
+        links = {"self": resource["links"]["self"]}
+        return envelope(resource, links=links, included=included and included.resources())
+    return cached_response(build, ("loans", "books") if include else ("loans",))
 
 @app.route("/loans/<loan_id>", methods=["PUT"])
 def update_loan(loan_id):
@@ -221,6 +333,7 @@ def update_loan(loan_id):
     if not loan:
         abort(404, description="Loan not found")
     loan.update({"book_id": payload["book_id"], "borrower": payload["borrower"]})
+    invalidate_cached_responses("loans")
     resource = loan_resource(loan)
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
 
@@ -230,6 +343,7 @@ def delete_loan(loan_id):
     if loan_id not in loans:
         abort(404, description="Loan not found")
     loans.pop(loan_id)
+    invalidate_cached_responses("loans")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -1,8 +1,12 @@
 import base64
+import functools
 import hashlib
 import hmac
+import itertools
 import json
+import threading
 import time
+from collections import OrderedDict
 from flask import Flask, abort, request, url_for
 from uuid import uuid4
 
@@ -13,7 +17,13 @@ books = {
 }
 loans = {}
 users = {"admin": {"password": "admin"}}
+collection_versions = {"books": 0, "loans": 0}
+version_sequence = itertools.count(1)
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
 SECRET = "change-me"
+TOKEN_CACHE_SIZE = 1024
+RESPONSE_CACHE_SIZE = 512
 
 def b64url_encode(data):
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
@@ -31,7 +41,8 @@ def encode_jwt(payload):
     signature_b64 = b64url_encode(signature)
     return f"{header_b64}.{payload_b64}.{signature_b64}"
 
-def decode_jwt(token):
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def verify_jwt(token):
     try:
         header_b64, payload_b64, signature_b64 = token.split(".")
     except ValueError:
@@ -41,7 +52,11 @@ def decode_jwt(token):
     provided_signature = b64url_decode(signature_b64)
     if not hmac.compare_digest(provided_signature, expected_signature):
         abort(401, description="Invalid token")
-    payload = json.loads(b64url_decode(payload_b64))
+    return json.loads(b64url_decode(payload_b64))
+
+def decode_jwt(token):
+    # Signature checks are cached per token string; expiry is still enforced on every call.
+    payload = verify_jwt(token)
     if "exp" in payload and time.time() > payload["exp"]:
         abort(401, description="Token expired")
     return payload
@@ -51,6 +66,11 @@ def require_fields(payload, fields):
     if missing:
         abort(400, description="Missing fields: " + ", ".join(missing))
 
+def require_strings(payload, fields):
+    invalid = [field for field in fields if not isinstance(payload[field], str)]
+    if invalid:
+        abort(400, description="Fields must be strings: " + ", ".join(invalid))
+
 def authenticate_request():
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
@@ -68,9 +88,32 @@ def json_response(data, status=200, cache_control="no-store", headers=None):
             response.headers[key] = value
     return response
 
-def cached_response(data, max_age=60):
-    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
-    etag = hashlib.sha256(body.encode()).hexdigest()
+def invalidate_cached_responses(collection):
+    collection_versions[collection] = next(version_sequence)
+
+def cached_response(build, depends_on, max_age=60):
+    """Serve a GET body and ETag from the response cache until a ``depends_on`` collection changes.
+
+    ``build`` is only called on a miss, so a conditional GET that hits the cache is answered
+    without rebuilding or hashing the payload.
+    """
+    key = request.full_path
+    version = tuple(collection_versions[collection] for collection in depends_on)
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is not None and entry[0] == version:
+            response_cache.move_to_end(key)
+        else:
+            entry = None
+    if entry is None:
+        body = json.dumps(build(), separators=(",", ":"), sort_keys=True).encode()
+        entry = (version, body, hashlib.sha256(body).hexdigest())
+        with response_cache_lock:
+            response_cache[key] = entry
+            response_cache.move_to_end(key)
+            while len(response_cache) > RESPONSE_CACHE_SIZE:
+                response_cache.popitem(last=False)
+    _, body, etag = entry
     if request.headers.get("If-None-Match") == etag:
         response = app.response_class(status=304)
     else:
@@ -79,14 +122,70 @@ def cached_response(data, max_age=60):
     response.headers["ETag"] = etag
     return response
 
-def envelope(data, links=None, meta=None):
+def envelope(data, links=None, meta=None, included=None):
     payload = {"data": data}
+    if included is not None:
+        payload["included"] = included
     if links:
         payload["links"] = links
     if meta:
         payload["meta"] = meta
     return payload
 
+class BookSearchIndex:
+    """Trigram index over lower-cased book titles and authors, maintained on every book write.
+
+    ``search`` only narrows the candidates; callers still run the substring test on them, so
+    results are identical to a full scan. Queries shorter than a trigram cannot use the index.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.grams = {}
+        self.order = {}
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def trigrams(text):
+        return {text[index:index + 3] for index in range(len(text) - 2)}
+
+    def _discard(self, book_id):
+        for gram in self.grams.pop(book_id, ()):
+            posting = self.postings[gram]
+            posting.discard(book_id)
+            if not posting:
+                del self.postings[gram]
+
+    def add(self, book):
+        grams = self.trigrams(book["title"].lower()) | self.trigrams(book["author"].lower())
+        with self.lock:
+            self._discard(book["id"])
+            self.order.setdefault(book["id"], next(self.sequence))
+            self.grams[book["id"]] = grams
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(book["id"])
+
+    def remove(self, book_id):
+        with self.lock:
+            self._discard(book_id)
+            self.order.pop(book_id, None)
+
+    def search(self, normalized_query):
+        """Return candidate book ids in catalogue order for a query of at least three characters."""
+        grams = self.trigrams(normalized_query)
+        with self.lock:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            candidates = postings[0].intersection(*postings[1:])
+            return sorted(candidates, key=self.order.__getitem__)
+
+book_index = BookSearchIndex()
+for seeded_book in books.values():
+    book_index.add(seeded_book)
+
+def book_matches(book, normalized_query):
+    return normalized_query in book["title"].lower() or normalized_query in book["author"].lower()
+
 def book_resource(book):
     return {
         "type": "book",
@@ -123,6 +222,54 @@ def loan_resource(loan):
         }
     }
 
+LOAN_INCLUDES = {"book"}
+
+def include_param(allowed):
+    names = {name.strip() for name in request.args.get("include", "").split(",") if name.strip()}
+    unknown = names - allowed
+    if unknown:
+        abort(400, description="Unsupported include: " + ", ".join(sorted(unknown)))
+    return names
+
+def sparse_fields():
+    """Read JSON:API ``fields[<type>]=a,b`` parameters into a mapping of type to field names."""
+    fields = {}
+    for key, value in request.args.items():
+        if key.startswith("fields[") and key.endswith("]"):
+            fields[key[len("fields["):-1]] = {name.strip() for name in value.split(",") if name.strip()}
+    return fields
+
+def compound_params():
+    return {key: value for key, value in request.args.items() if key == "include" or key.startswith("fields[")}
+
+def sparse_fieldset(resource, fields):
+    wanted = fields.get(resource["type"])
+    if wanted is None:
+        return resource
+    resource["attributes"] = {name: value for name, value in resource["attributes"].items() if name in wanted}
+    if "relationships" in resource:
+        resource["relationships"] = {name: value for name, value in resource["relationships"].items() if name in wanted}
+    return resource
+
+class IncludedBooks:
+    """Collects the distinct books referenced by a set of loans for a compound document."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.book_ids = {}
+
+    def add(self, loan):
+        self.book_ids.setdefault(loan["book_id"], None)
+
+    def resources(self):
+        found = (books.get(book_id) for book_id in self.book_ids)
+        return [sparse_fieldset(book_resource(book), self.fields) for book in found if book]
+
+def loan_document_resource(loan, fields, included=None):
+    if included is not None:
+        included.add(loan)
+    return sparse_fieldset(loan_resource(loan), fields)
+
 @app.route("/auth/login", methods=["POST"])
 def login():
     payload = request.get_json(force=True)
@@ -146,53 +293,62 @@ def list_books():
         abort(400, description="Invalid pagination parameters")
     if page < 1 or page_size < 1 or page_size > 100:
         abort(400, description="Invalid pagination parameters")
-    normalized_query = query_param.strip().lower()
-    filtered_books = []
-    for book in books.values():
-        if not normalized_query or normalized_query in book["title"].lower() or normalized_query in book["author"].lower():
-            filtered_books.append(book)
-    total_items = len(filtered_books)
-    if total_items == 0 and page != 1:
-        abort(404, description="Page not found")
-    total_pages = max(1, (total_items + page_size - 1) // page_size) if total_items else 1
-    if total_items > 0 and page > total_pages:
-        abort(404, description="Page not found")
-    start = (page - 1) * page_size
-    end = start + page_size
-    paginated_books = filtered_books[start:end]
-    resources = [book_resource(book) for book in paginated_books]
-    meta = {
-        "count": len(resources),
-        "total_count": total_items,
-        "page": page,
-        "page_size": page_size,
-        "total_pages": total_pages,
-    }
-    if query_param:
-        meta["query"] = query_param
 
-    def page_link(target_page):
-        params = {}
+    def build():
+        normalized_query = query_param.strip().lower()
+        if not normalized_query:
+            filtered_books = list(books.values())
+        elif len(normalized_query) < 3:
+            filtered_books = [book for book in books.values() if book_matches(book, normalized_query)]
+        else:
+            candidates = (books.get(book_id) for book_id in book_index.search(normalized_query))
+            filtered_books = [book for book in candidates if book and book_matches(book, normalized_query)]
+        total_items = len(filtered_books)
+        if total_items == 0 and page != 1:
+            abort(404, description="Page not found")
+        total_pages = max(1, (total_items + page_size - 1) // page_size) if total_items else 1
+        if total_items > 0 and page > total_pages:
+            abort(404, description="Page not found")
+        start = (page - 1) * page_size
+        end = start + page_size
+        paginated_books = filtered_books[start:end]
+        resources = [book_resource(book) for book in paginated_books]
+        meta = {
+            "count": len(resources),
+            "total_count": total_items,
+            "page": page,
+            "page_size": page_size,
+            "total_pages": total_pages,
+        }
         if query_param:
-            params["q"] = query_param
-        params["page"] = target_page
-        params["page_size"] = page_size
-        return url_for("list_books", **params)
-    links = {"self": page_link(page), "first": page_link(1), "last": page_link(total_pages)}
-    if page > 1:
-        links["prev"] = page_link(page - 1)
-    if total_items > page * page_size:
-        links["next"] = page_link(page + 1)
-    return cached_response(envelope(resources, links=links, meta=meta))
+            meta["query"] = query_param
+
+        def page_link(target_page):
+            params = {}
+            if query_param:
+                params["q"] = query_param
+            params["page"] = target_page
+            params["page_size"] = page_size
+            return url_for("list_books", **params)
+        links = {"self": page_link(page), "first": page_link(1), "last": page_link(total_pages)}
+        if page > 1:
+            links["prev"] = page_link(page - 1)
+        if total_items > page * page_size:
+            links["next"] = page_link(page + 1)
+        return envelope(resources, links=links, meta=meta)
+    return cached_response(build, ("books",))
 
 @app.route("/books", methods=["POST"])
 def create_book():
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["title", "author"])
+    require_strings(payload, ["title", "author"])
     book_id = str(uuid4())
     book = {"id": book_id, "title": payload["title"], "author": payload["author"]}
     books[book_id] = book
+    book_index.add(book)
+    invalidate_cached_responses("books")
     resource = book_resource(book)
     location = resource["links"]["self"]
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
@@ -203,18 +359,24 @@ def retrieve_book(book_id):
     book = books.get(book_id)
     if not book:
         abort(404, description="Book not found")
-    resource = book_resource(book)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+
+    def build():
+        resource = book_resource(book)
+        return envelope(resource, links={"self": resource["links"]["self"]})
+    return cached_response(build, ("books",))
 
 @app.route("/books/<book_id>", methods=["PUT"])
 def update_book(book_id):
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["title", "author"])
+    require_strings(payload, ["title", "author"])
     book = books.get(book_id)
     if not book:
         abort(404, description="Book not found")
     book.update({"title": payload["title"], "author": payload["author"]})
+    book_index.add(book)
+    invalidate_cached_responses("books")
     resource = book_resource(book)
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
 
@@ -224,6 +386,8 @@ def delete_book(book_id):
     if book_id not in books:
         abort(404, description="Book not found")
     books.pop(book_id)
+    book_index.remove(book_id)
+    invalidate_cached_responses("books")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -231,9 +395,16 @@ def delete_book(book_id):
 @app.route("/loans", methods=["GET"])
 def list_loans():
     authenticate_request()
-    resources = [loan_resource(loan) for loan in loans.values()]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_loans")}, meta=meta))
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        resources = [loan_document_resource(loan, fields, included) for loan in loans.values()]
+        meta = {"count": len(resources)}
+        links = {"self": url_for("list_loans", **compound_params())}
+        return envelope(resources, links=links, meta=meta, included=included and included.resources())
+    return cached_response(build, ("loans", "books") if include else ("loans",))
 
 @app.route("/loans", methods=["POST"])
 def create_loan():
@@ -245,6 +416,7 @@ def create_loan():
     loan_id = str(uuid4())
     loan = {"id": loan_id, "book_id": payload["book_id"], "borrower": payload["borrower"]}
     loans[loan_id] = loan
+    invalidate_cached_responses("loans")
     resource = loan_resource(loan)
     location = resource["links"]["self"]
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
@@ -255,8 +427,15 @@ def retrieve_loan(loan_id):
     loan = loans.get(loan_id)
     if not loan:
         abort(404, description="Loan not found")
-    resource = loan_resource(loan)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        resource = loan_document_resource(loan, fields, included)
+        links = {"self": resource["links"]["self"]}
+        return envelope(resource, links=links, included=included and included.resources())
+    return cached_response(build, ("loans", "books") if include else ("loans",))
 
 @app.route("/loans/<loan_id>", methods=["PUT"])
 def update_loan(loan_id):
@@ -269,6 +448,7 @@ def update_loan(loan_id):
     if not loan:
         abort(404, description="Loan not found")
     loan.update({"book_id": payload["book_id"], "borrower": payload["borrower"]})
+    invalidate_cached_responses("loans")
     resource = loan_resource(loan)
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
 
@@ -278,6 +458,7 @@ def delete_loan(loan_id):
     if loan_id not in loans:
         abort(404, description="Loan not found")
     loans.pop(loan_id)
+    invalidate_cached_responses("loans")
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
@@ -1,27 +1,131 @@
+import atexit
 import base64
+import bisect
+import functools
 import hashlib
+import heapq
 import hmac
-import json
+import http.client
+import itertools
+import os
+import queue
+import random
+import secrets
+import threading
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
-from urllib import error, request as urlrequest
+from urllib.parse import urlsplit
 from uuid import uuid4
 
-from flask import Flask, abort, request, url_for
+from flask import Flask, abort, g, request, stream_with_context, url_for
+from werkzeug.exceptions import HTTPException
+
+from bloom import BloomFilter
+from codec import dumpb, dumps, loads
+from metrics import Registry
+from passwords import FailedLoginCache, HasherBusy, PasswordHasher, hash_password, needs_rehash
+from ratelimit import open_rate_limiter
+from records import Book, Delivery, Loan, WebhookEvent, record_default
+from storage import open_storage
 
 app = Flask(__name__)
-books = {
-    "book-nguoi-la": {"id": "book-nguoi-la", "title": "Nguoi La Trong Guong", "author": "Nguyen Nhat Anh"},
-    "book-dat-rung": {"id": "book-dat-rung", "title": "Dat Rung Phuong Nam", "author": "Doan Gioi"},
-}
-loans = {}
-users = {"admin": {"password": "admin"}}
-webhook_subscriptions = {}
-webhook_events = []
-webhook_deliveries = []
+storage = open_storage(os.environ.get("LIBRARY_STORAGE", "memory"))
+atexit.register(storage.close)
+# Set by serve.py. Webhook history and the event stream are per process, so they need to know.
+WORKER_COUNT = int(os.environ.get("LIBRARY_WORKERS", "1"))
+books = storage.table("books", "id", Book.__slots__, indexes=("title", "author"), record=Book, ordered=True)
+loans = storage.table("loans", "id", Loan.__slots__, indexes=("book_id", "borrower"), record=Loan, ordered=True)
+users = storage.table("users", "username", ("password",))
+jwt_keys = storage.table("jwt_keys", "kid", ("secret", "retires_at"))
+refresh_tokens = storage.table("refresh_tokens", "id", ("sub", "expires_at"), indexes=("expires_at",))
+revoked_tokens = storage.table("revoked_tokens", "jti", ("expires_at",), indexes=("expires_at",))
+webhook_subscriptions = storage.table(
+    "webhook_subscriptions", "id", ("id", "url", "secret", "events", "batch", "created_at"), json_columns=("events", "batch")
+)
+webhook_dead_letters = {}
+dead_letter_lock = threading.Lock()
+collection_versions = {"books": 0, "loans": 0}
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
 SECRET = "change-me"
+SECRET_KID = "default"
+ACCESS_TOKEN_LIFETIME = 900
+REFRESH_TOKEN_LIFETIME = 30 * 24 * 3600
+# A replaced key keeps verifying for one token lifetime, so rotation never cuts a session short.
+JWT_KEY_GRACE_PERIOD = ACCESS_TOKEN_LIFETIME
+REVOCATION_FILTER_CAPACITY = 10000
+TOKEN_PRUNE_INTERVAL = 300.0
+TOKEN_CACHE_SIZE = 1024
+RESPONSE_CACHE_SIZE = 512
+ETAG_EPOCH = uuid4().hex[:8]
+# Every worker serve.py forks shares ETAG_EPOCH; versions of per-process state add this as well.
+PROCESS_ID = ETAG_EPOCH
+STREAMING_THRESHOLD = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+BATCH_MAX_ITEMS = 5000
 ALLOWED_WEBHOOK_EVENTS = {"loan.created", "loan.updated", "loan.deleted"}
-WEBHOOK_HISTORY_LIMIT = 50
+WEBHOOK_HISTORY_LIMIT = int(os.environ.get("WEBHOOK_HISTORY_LIMIT", "50"))
+WEBHOOK_WORKERS = 4
+WEBHOOK_MAX_IN_FLIGHT_PER_SUBSCRIPTION = 2
+WEBHOOK_MAX_ATTEMPTS = 5
+WEBHOOK_RETRY_BASE_DELAY = 1.0
+WEBHOOK_RETRY_MAX_DELAY = 60.0
+WEBHOOK_DEAD_LETTER_LIMIT = 1000
+WEBHOOK_TIMEOUT = 5
+WEBHOOK_POOL_MAX_PER_HOST = 4
+WEBHOOK_POOL_IDLE_TIMEOUT = 30.0
+WEBHOOK_BATCH_MAX_SIZE = 100
+WEBHOOK_BATCH_SIZE_LIMIT = 1000
+WEBHOOK_BATCH_LINGER = 1.0
+WEBHOOK_BATCH_LINGER_LIMIT = 60.0
+EVENT_STREAM_BUFFER_SIZE = 1000
+EVENT_STREAM_HEARTBEAT = 15.0
+EVENT_STREAM_RETRY_MS = 3000
+# (tokens per second, burst) per endpoint; the rest share RATE_LIMIT_DEFAULT.
+RATE_LIMIT_DEFAULT = (20.0, 40)
+RATE_LIMITS = {
+    "login": (0.2, 5),
+    "batch_books": (1.0, 5),
+    "batch_loans": (1.0, 5),
+    "stream_events": (0.1, 3),
+}
+# Long enough for every bucket to refill, so evicting an idle one never resets it early.
+RATE_LIMIT_IDLE_TIMEOUT = max(burst / rate for rate, burst in [RATE_LIMIT_DEFAULT, *RATE_LIMITS.values()])
+rate_limiter = open_rate_limiter(os.environ.get("LIBRARY_RATE_LIMIT", "local"), storage, RATE_LIMIT_IDLE_TIMEOUT)
+metrics_registry = Registry()
+request_latency = metrics_registry.histogram(
+    "library_request_duration_seconds", "Time from the start of a request until its response headers are ready.",
+    ("route", "method"),
+)
+authentication_latency = metrics_registry.histogram(
+    "library_authenticate_duration_seconds", "Time spent in authenticate_request.", ("route",)
+)
+serialization_latency = metrics_registry.histogram(
+    "library_serialization_duration_seconds", "Time spent producing JSON response bodies.", ("route", "function")
+)
+webhook_dispatch_latency = metrics_registry.histogram(
+    "library_webhook_dispatch_duration_seconds", "Time spent in dispatch_webhook, including the HTTP round trip."
+)
+etag_requests = metrics_registry.counter(
+    "library_etag_requests_total", "Cacheable GETs answered 304 Not Modified (hit) or with a body (miss).",
+    ("route", "result"),
+)
+webhook_deliveries_total = metrics_registry.counter(
+    "library_webhook_deliveries_total", "Webhook delivery attempts by result.", ("result",)
+)
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "200000"))
+PASSWORD_HASH_WORKERS = 2
+PASSWORD_HASH_QUEUE_LIMIT = 16
+FAILED_LOGIN_CACHE_TTL = 30.0
+password_hasher = PasswordHasher(PASSWORD_HASH_ITERATIONS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE_LIMIT)
+failed_logins = FailedLoginCache(FAILED_LOGIN_CACHE_TTL)
+if storage.is_new:
+    books.update({
+        "book-nguoi-la": Book(id="book-nguoi-la", title="Nguoi La Trong Guong", author="Nguyen Nhat Anh", revision=1),
+        "book-dat-rung": Book(id="book-dat-rung", title="Dat Rung Phuong Nam", author="Doan Gioi", revision=1),
+    })
+    users["admin"] = {"password": hash_password("admin", PASSWORD_HASH_ITERATIONS)}
 
 def b64url_encode(data):
     return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
@@ -30,45 +134,212 @@ def b64url_decode(data):
     padding = "=" * (-len(data) % 4)
     return base64.urlsafe_b64decode((data + padding).encode())
 
+def load_signing_keys():
+    """Rebuild this process's key ring from the ``jwt_keys`` table shared by every worker."""
+    global signing_keys, active_signing_kid
+    keys = {}
+    active_kid = None
+    for kid, row in jwt_keys.items():
+        keys[kid] = (hmac.new(row["secret"].encode(), digestmod=hashlib.sha256), row["retires_at"])
+        if row["retires_at"] is None:
+            active_kid = kid
+    # Publish the keys before the kid, so any kid another thread reads is already in the ring.
+    signing_keys = keys
+    active_signing_kid = active_kid
+
+def signing_key(kid):
+    """Return the prebuilt HMAC for ``kid``, or None once it is unknown or past its grace window."""
+    key, retires_at = signing_keys.get(kid, (None, None))
+    if retires_at is not None and time.time() > retires_at:
+        return None
+    return key
+
+def sign(key, signing_input):
+    # Copying an already keyed HMAC skips hashing the secret into fresh pads on every call.
+    mac = key.copy()
+    mac.update(signing_input)
+    return mac.digest()
+
+def rotate_signing_key(kid=None):
+    kid = kid or uuid4().hex[:8]
+    with storage.transaction():
+        if kid in jwt_keys:
+            abort(409, description="Key id already in use")
+        now = time.time()
+        retires_at = now + JWT_KEY_GRACE_PERIOD
+        previous_kid = None
+        for key_id, row in list(jwt_keys.items()):
+            if row["retires_at"] is None:
+                previous_kid = key_id
+                jwt_keys[key_id] = {"secret": row["secret"], "retires_at": retires_at}
+            elif row["retires_at"] < now:
+                del jwt_keys[key_id]
+        jwt_keys[kid] = {"secret": secrets.token_hex(32), "retires_at": None}
+    record_change("jwt_keys", kid)
+    return kid, previous_kid, retires_at
+
+def token_kid(header_b64):
+    try:
+        header = loads(b64url_decode(header_b64))
+    except ValueError:
+        abort(401, description="Invalid token")
+    if not isinstance(header, dict):
+        abort(401, description="Invalid token")
+    # Tokens issued before key rotation existed carry no kid and were signed with SECRET.
+    kid = header.get("kid", SECRET_KID)
+    if not isinstance(kid, str):
+        abort(401, description="Invalid token")
+    return kid
+
 def encode_jwt(payload):
-    header = {"alg": "HS256", "typ": "JWT"}
-    header_b64 = b64url_encode(json.dumps(header, separators=(",", ":")).encode())
-    payload_b64 = b64url_encode(json.dumps(payload, separators=(",", ":")).encode())
+    kid = active_signing_kid
+    header = {"alg": "HS256", "kid": kid, "typ": "JWT"}
+    header_b64 = b64url_encode(dumpb(header, sort_keys=False))
+    payload_b64 = b64url_encode(dumpb(payload, sort_keys=False))
     signing_input = f"{header_b64}.{payload_b64}".encode()
-    signature = hmac.new(SECRET.encode(), signing_input, hashlib.sha256).digest()
+    signature = sign(signing_keys[kid][0], signing_input)
     signature_b64 = b64url_encode(signature)
     return f"{header_b64}.{payload_b64}.{signature_b64}"
 
-def decode_jwt(token):
+@functools.lru_cache(maxsize=TOKEN_CACHE_SIZE)
+def verify_jwt(token):
     try:
         header_b64, payload_b64, signature_b64 = token.split(".")
     except ValueError:
         abort(401, description="Invalid token")
+    kid = token_kid(header_b64)
+    key = signing_key(kid)
+    if key is None:
+        abort(401, description="Invalid token")
     signing_input = f"{header_b64}.{payload_b64}".encode()
-    expected_signature = hmac.new(SECRET.encode(), signing_input, hashlib.sha256).digest()
+    expected_signature = sign(key, signing_input)
     provided_signature = b64url_decode(signature_b64)
     if not hmac.compare_digest(provided_signature, expected_signature):
         abort(401, description="Invalid token")
-    payload = json.loads(b64url_decode(payload_b64))
+    return kid, loads(b64url_decode(payload_b64))
+
+def decode_jwt(token):
+    # Signature checks are cached per token string; expiry and the key's grace window are
+    # still enforced on every call.
+    kid, payload = verify_jwt(token)
+    if signing_key(kid) is None:
+        abort(401, description="Invalid token")
     if "exp" in payload and time.time() > payload["exp"]:
         abort(401, description="Token expired")
+    if "jti" in payload and token_revoked(payload["jti"]):
+        abort(401, description="Token revoked")
     return payload
 
+def token_revoked(jti):
+    token_pruner.start()
+    # Almost every token is not revoked, and the filter answers that without touching storage.
+    if jti not in revocation_filter:
+        return False
+    return jti in revoked_tokens
+
+def revoke_token(payload):
+    revoked_tokens[payload["jti"]] = {"expires_at": payload["exp"]}
+    record_change("revoked_tokens", payload["jti"])
+
+def load_revocation_filter():
+    """Rebuild this process's filter from the revocations that have not expired yet."""
+    global revocation_filter
+    jtis = list(revoked_tokens)
+    revocation_filter = BloomFilter(max(REVOCATION_FILTER_CAPACITY, 2 * len(jtis)))
+    for jti in jtis:
+        revocation_filter.add(jti)
+
+def prune_expired_tokens():
+    """Drop expired revocations and refresh tokens, one DELETE per table."""
+    now = time.time()
+    # A revocation only has to outlive the token it revokes, which expiry rejects anyway.
+    storage.delete_before(refresh_tokens, "expires_at", now)
+    if storage.delete_before(revoked_tokens, "expires_at", now):
+        # Bloom filters cannot forget, so pruned jtis only leave the filter when it is rebuilt.
+        # The rebuild holds change_lock, so a revocation replayed meanwhile is either read from
+        # the table or added to the new filter, never only to the old one being replaced.
+        with change_lock:
+            load_revocation_filter()
+
+class TokenPruner:
+    """Runs ``prune_expired_tokens`` every ``interval`` seconds on a thread of its own.
+
+    The thread starts with the first token check, so with serve.py every forked worker runs
+    its own, and requests never wait for a prune.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="token-pruner", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                prune_expired_tokens()
+            except Exception:
+                app.logger.exception("Pruning expired tokens failed")
+            time.sleep(self.interval)
+
+def refresh_token_id(refresh_token):
+    # Only a digest is stored, so a copy of the table cannot be used to refresh.
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+def issue_tokens(subject):
+    now = int(time.time())
+    token = encode_jwt({"sub": subject, "exp": now + ACCESS_TOKEN_LIFETIME, "jti": uuid4().hex})
+    refresh_token = secrets.token_urlsafe(32)
+    refresh_tokens[refresh_token_id(refresh_token)] = {"sub": subject, "expires_at": now + REFRESH_TOKEN_LIFETIME}
+    return {"token": token, "refresh_token": refresh_token, "expires_in": ACCESS_TOKEN_LIFETIME}
+
+def missing_fields(payload, fields):
+    return [field for field in fields if field not in payload]
+
+def non_string_fields(payload, fields):
+    return [field for field in fields if not isinstance(payload[field], str)]
+
 def require_fields(payload, fields):
-    missing = [field for field in fields if field not in payload]
+    missing = missing_fields(payload, fields)
     if missing:
         abort(400, description="Missing fields: " + ", ".join(missing))
 
-def authenticate_request():
+def require_strings(payload, fields):
+    invalid = non_string_fields(payload, fields)
+    if invalid:
+        abort(400, description="Fields must be strings: " + ", ".join(invalid))
+
+def request_token():
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
         abort(401, description="Missing token")
-    token = auth_header.split(" ", 1)[1]
-    payload = decode_jwt(token)
-    return payload.get("sub")
+    return decode_jwt(auth_header.split(" ", 1)[1])
+
+def authenticate_request():
+    start = time.perf_counter()
+    try:
+        return request_token().get("sub")
+    finally:
+        authentication_latency.observe(time.perf_counter() - start, route_label())
+
+def route_label():
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+def canonical_json(data):
+    return dumps(data, default=record_default)
 
 def json_response(data, status=200, cache_control="no-store", headers=None):
-    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
+    start = time.perf_counter()
+    body = canonical_json(data)
+    serialization_latency.observe(time.perf_counter() - start, route_label(), "json_response")
     response = app.response_class(body, status=status, mimetype="application/json")
     response.headers["Cache-Control"] = cache_control
     if headers:
@@ -76,25 +347,466 @@ def json_response(data, status=200, cache_control="no-store", headers=None):
             response.headers[key] = value
     return response
 
-def cached_response(data, max_age=60):
-    body = json.dumps(data, separators=(",", ":"), sort_keys=True)
-    etag = hashlib.sha256(body.encode()).hexdigest()
+def reset_process_id():
+    global PROCESS_ID
+    PROCESS_ID = uuid4().hex[:8]
+
+os.register_at_fork(after_in_child=reset_process_id)
+
+def weak_etag(version):
+    return 'W/"' + "-".join(str(part) for part in (ETAG_EPOCH,) + version) + '"'
+
+def cached_body(build, version):
+    key = request.full_path
+    with response_cache_lock:
+        entry = response_cache.get(key)
+        if entry is not None and entry[0] == version:
+            response_cache.move_to_end(key)
+            return entry[1]
+    body = dumpb(build(), default=record_default)
+    with response_cache_lock:
+        response_cache[key] = (version, body)
+        response_cache.move_to_end(key)
+        while len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+    return body
+
+def cached_response(build, version, max_age=60):
+    """Serve a GET whose representation is identified by the ``version`` tuple.
+
+    The weak ETag is derived from ``version`` alone, so a matching conditional GET is answered
+    in O(1). Otherwise ``build`` runs only when the cached body for this path is out of date.
+    """
+    etag = weak_etag(version)
     if request.headers.get("If-None-Match") == etag:
+        etag_requests.inc(route_label(), "hit")
         response = app.response_class(status=304)
     else:
+        etag_requests.inc(route_label(), "miss")
+        start = time.perf_counter()
+        body = cached_body(build, version)
+        serialization_latency.observe(time.perf_counter() - start, route_label(), "cached_response")
         response = app.response_class(body, mimetype="application/json")
     response.headers["Cache-Control"] = f"private, max-age={max_age}"
     response.headers["ETag"] = etag
     return response
 
-def envelope(data, links=None, meta=None):
+def streamed_response(items, to_json, links, version, max_age=60, included=None, meta=None):
+    """Stream a collection envelope resource by resource instead of serializing it in one piece.
+
+    The ETag comes from ``version``, so it is known before the first byte is sent. ``meta``
+    sorts after ``data``, which lets the count be written once the items have been emitted;
+    ``included`` resources, gathered by ``to_json`` along the way, are written the same way.
+    """
+    etag = weak_etag(version)
+    if request.headers.get("If-None-Match") == etag:
+        etag_requests.inc(route_label(), "hit")
+        response = app.response_class(status=304)
+    else:
+        etag_requests.inc(route_label(), "miss")
+        def generate():
+            buffer = ['{"data":[']
+            size = 0
+            count = 0
+            for item in items:
+                chunk = to_json(item)
+                buffer.append("," + chunk if count else chunk)
+                size += len(chunk)
+                count += 1
+                if size >= STREAM_CHUNK_SIZE:
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+            buffer.append("]")
+            if included is not None:
+                buffer.append(',"included":' + canonical_json(included.resources()))
+            buffer.append(',"links":' + canonical_json(links))
+            buffer.append(',"meta":' + dumps(dict(meta or {}, count=count)) + "}")
+            yield "".join(buffer)
+        response = app.response_class(stream_with_context(generate()), mimetype="application/json")
+    response.headers["Cache-Control"] = f"private, max-age={max_age}"
+    response.headers["ETag"] = etag
+    return response
+
+def envelope(data, links=None, meta=None, included=None):
     payload = {"data": data}
+    if included is not None:
+        payload["included"] = included
     if links:
         payload["links"] = links
     if meta:
         payload["meta"] = meta
     return payload
 
+class BookSearchIndex:
+    """Trigram index over lower-cased book titles and authors, maintained on every book write.
+
+    ``search`` only narrows the candidates; callers still run the substring test on them, so
+    results are identical to a full scan. Queries shorter than a trigram cannot use the index.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.grams = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.postings.clear()
+            self.grams.clear()
+
+    @staticmethod
+    def trigrams(text):
+        return {text[index:index + 3] for index in range(len(text) - 2)}
+
+    def _discard(self, book_id):
+        for gram in self.grams.pop(book_id, ()):
+            posting = self.postings[gram]
+            posting.discard(book_id)
+            if not posting:
+                del self.postings[gram]
+
+    def add(self, book):
+        grams = self.trigrams(book["title"].lower()) | self.trigrams(book["author"].lower())
+        with self.lock:
+            self._discard(book["id"])
+            self.grams[book["id"]] = grams
+            for gram in grams:
+                self.postings.setdefault(gram, set()).add(book["id"])
+
+    def remove(self, book_id):
+        with self.lock:
+            self._discard(book_id)
+
+    def search(self, normalized_query):
+        """Return the set of candidate book ids for a query of at least three characters."""
+        grams = self.trigrams(normalized_query)
+        with self.lock:
+            postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+            return postings[0].intersection(*postings[1:])
+
+class KeysetIndex:
+    """Keeps ids in creation order under their storage positions, for cursor pagination.
+
+    Positions are assigned by the storage engine when a row is first written and never change
+    or get reused, so a cursor means the same thing in every worker and after a restart. The
+    page after a cursor is found by bisection in O(log n + limit), however deep it is.
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.ids = {}
+        self.key_of = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.keys.clear()
+            self.ids.clear()
+            self.key_of.clear()
+
+    def add(self, item_id, key):
+        with self.lock:
+            if item_id in self.key_of:
+                return
+            # Changes usually arrive in position order, making this an append.
+            bisect.insort(self.keys, key)
+            self.ids[key] = item_id
+            self.key_of[item_id] = key
+
+    def remove(self, item_id):
+        with self.lock:
+            key = self.key_of.pop(item_id, None)
+            if key is None:
+                return
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            del self.ids[key]
+
+    def after(self, key, count):
+        with self.lock:
+            start = bisect.bisect_right(self.keys, key)
+            return [(next_key, self.ids[next_key]) for next_key in self.keys[start:start + count]]
+
+    def iter_after(self, key, chunk_size=256):
+        while True:
+            chunk = self.after(key, chunk_size)
+            yield from chunk
+            if len(chunk) < chunk_size:
+                return
+            key = chunk[-1][0]
+
+    def slice(self, start, stop):
+        with self.lock:
+            return [self.ids[key] for key in self.keys[start:stop]]
+
+    def ordered(self, item_ids):
+        with self.lock:
+            return sorted((self.key_of[item_id], item_id) for item_id in item_ids if item_id in self.key_of)
+
+class GroupIndex:
+    """Maps a field value to the ids of the items carrying it, e.g. a book id to its loan ids.
+
+    Values are indexed by their string form, which is how they arrive in query parameters.
+    """
+
+    def __init__(self):
+        self.groups = {}
+        self.value_of = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.groups.clear()
+            self.value_of.clear()
+
+    def _discard(self, item_id):
+        if item_id not in self.value_of:
+            return
+        value = self.value_of.pop(item_id)
+        group = self.groups[value]
+        group.discard(item_id)
+        if not group:
+            del self.groups[value]
+
+    def add(self, item_id, value):
+        with self.lock:
+            self._discard(item_id)
+            self.value_of[item_id] = str(value)
+            self.groups.setdefault(str(value), set()).add(item_id)
+
+    def remove(self, item_id):
+        with self.lock:
+            self._discard(item_id)
+
+    def get(self, value):
+        with self.lock:
+            return set(self.groups.get(value, ()))
+
+    def count(self, value):
+        with self.lock:
+            return len(self.groups.get(value, ()))
+
+book_index = BookSearchIndex()
+book_keys = KeysetIndex()
+loan_keys = KeysetIndex()
+LOAN_FILTERS = ("book_id", "borrower")
+loan_groups = {field: GroupIndex() for field in LOAN_FILTERS}
+change_lock = threading.Lock()
+
+def load_indexes():
+    book_index.clear()
+    book_keys.clear()
+    loan_keys.clear()
+    for group in loan_groups.values():
+        group.clear()
+    # Rows written after the positions were read are indexed when their change is replayed.
+    book_positions = {book_id: position for position, book_id in books.positions()}
+    for book in books.values():
+        if book["id"] in book_positions:
+            index_row(index_book, "books", book, book_positions[book["id"]])
+    loan_positions = {loan_id: position for position, loan_id in loans.positions()}
+    for loan in loans.values():
+        if loan["id"] in loan_positions:
+            index_row(index_loan, "loans", loan, loan_positions[loan["id"]])
+
+def index_row(index, collection, row, position):
+    # A row stored before its fields were validated is left out of the indexes, not fatal to start-up.
+    try:
+        index(row, position)
+    except Exception:
+        app.logger.exception("Could not index %s %s", collection, row["id"])
+
+def index_book(book, position):
+    book_index.add(book)
+    book_keys.add(book["id"], position)
+
+def index_loan(loan, position):
+    loan_keys.add(loan["id"], position)
+    for field, group in loan_groups.items():
+        group.add(loan["id"], loan[field])
+
+def unindex_loan(loan_id):
+    loan_keys.remove(loan_id)
+    for group in loan_groups.values():
+        group.remove(loan_id)
+
+def apply_changes():
+    """Replay the shared change log into this process's indexes and cache versions.
+
+    Keyset keys are the rows' stored positions, so cursors agree across workers, whether a
+    worker replays the log or, having fallen behind the pruned log, rebuilds from the tables.
+    """
+    global applied_change_seq
+    with change_lock:
+        changes = storage.changes_since(applied_change_seq)
+        if changes is None:
+            # This process fell behind the pruned log; rebuild from the tables instead.
+            applied_change_seq = storage.latest_change()
+            collection_versions["books"] = collection_versions["loans"] = applied_change_seq
+            load_indexes()
+            load_signing_keys()
+            load_revocation_filter()
+            return
+        for seq, collection, item_id in changes:
+            try:
+                apply_change(collection, item_id)
+            except Exception:
+                # Skip an entry that cannot be applied rather than retrying it before every request.
+                app.logger.exception("Could not apply change %s to %s %s", seq, collection, item_id)
+            if collection in collection_versions:
+                collection_versions[collection] = seq
+            applied_change_seq = seq
+
+def apply_change(collection, item_id):
+    if collection == "books":
+        book = books.get(item_id)
+        position = books.position(item_id) if book else None
+        if position is not None:
+            index_book(book, position)
+        else:
+            book_index.remove(item_id)
+            book_keys.remove(item_id)
+    elif collection == "loans":
+        loan = loans.get(item_id)
+        position = loans.position(item_id) if loan else None
+        if position is not None:
+            index_loan(loan, position)
+        else:
+            unindex_loan(item_id)
+    elif collection == "jwt_keys":
+        load_signing_keys()
+    elif collection == "revoked_tokens":
+        revocation_filter.add(item_id)
+
+def record_change(collection, item_id):
+    storage.append_change(collection, item_id)
+    apply_changes()
+
+def record_changes(collection, item_ids):
+    if item_ids:
+        storage.append_changes(collection, item_ids)
+
+applied_change_seq = storage.latest_change()
+collection_versions["books"] = collection_versions["loans"] = applied_change_seq
+load_indexes()
+if not len(jwt_keys):
+    jwt_keys[SECRET_KID] = {"secret": SECRET, "retires_at": None}
+load_signing_keys()
+token_pruner = TokenPruner(TOKEN_PRUNE_INTERVAL)
+load_revocation_filter()
+
+# Registered first so the time spent in every other hook, including rate limiting, is counted.
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.get("request_started")
+    if started is not None:
+        request_latency.observe(time.perf_counter() - started, route_label(), request.method)
+    return response
+
+def rate_limit_client():
+    # Signed-in callers share one bucket wherever they connect from; everyone else, and every
+    # login attempt, is limited per IP address.
+    if request.endpoint != "login" and request.headers.get("Authorization", "").startswith("Bearer "):
+        # request_token, not authenticate_request, so the limiter adds no authentication sample.
+        try:
+            subject = request_token().get("sub")
+        except HTTPException:
+            subject = None
+        if subject:
+            return "sub:" + str(subject)
+    return "ip:" + str(request.remote_addr)
+
+@app.after_request
+def add_rate_limit_headers(response):
+    decision = g.get("rate_limit")
+    if decision is not None:
+        response.headers["RateLimit-Limit"] = str(decision.limit)
+        response.headers["RateLimit-Remaining"] = str(decision.remaining)
+        response.headers["RateLimit-Reset"] = str(decision.reset)
+        response.headers["RateLimit-Policy"] = g.rate_limit_policy
+    return response
+
+@app.before_request
+def sync_shared_state():
+    apply_changes()
+
+# Registered after sync_shared_state, so tokens signed by a key another worker just rotated in
+# are recognised and counted against their subject.
+@app.before_request
+def enforce_rate_limit():
+    if rate_limiter is None:
+        return
+    endpoint = request.endpoint if request.endpoint in RATE_LIMITS else "default"
+    rate, burst = RATE_LIMITS.get(endpoint, RATE_LIMIT_DEFAULT)
+    g.rate_limit = decision = rate_limiter.acquire(f"{endpoint}|{rate_limit_client()}", rate, burst)
+    g.rate_limit_policy = f"{burst};w={round(burst / rate)}"
+    if not decision.allowed:
+        abort(429, description="Rate limit exceeded", retry_after=decision.retry_after)
+
+def encode_cursor(key):
+    return b64url_encode(str(key).encode())
+
+def decode_cursor(cursor):
+    try:
+        key = int(b64url_decode(cursor))
+    except ValueError:
+        abort(400, description="Invalid cursor")
+    if key < 0:
+        abort(400, description="Invalid cursor")
+    return key
+
+def wants_cursor_pagination():
+    return "after" in request.args or "limit" in request.args
+
+def cursor_params():
+    try:
+        limit = int(request.args.get("limit", "10"))
+    except ValueError:
+        abort(400, description="Invalid pagination parameters")
+    if limit < 1 or limit > 100:
+        abort(400, description="Invalid pagination parameters")
+    after_param = request.args.get("after")
+    return (decode_cursor(after_param) if after_param else 0), limit
+
+def cursor_page(pairs, limit):
+    """Take up to ``limit`` items from ordered (key, item) pairs, plus the cursor of the next page."""
+    window = list(itertools.islice(pairs, limit + 1))
+    next_cursor = encode_cursor(window[limit - 1][0]) if len(window) > limit else None
+    return [item for _, item in window[:limit]], next_cursor
+
+def book_matches(book, normalized_query):
+    return normalized_query in book["title"].lower() or normalized_query in book["author"].lower()
+
+class LinkTemplate:
+    """Precompiled ``url_for(endpoint, <argument>=value)`` for the per-item links in resources.
+
+    The endpoint is routed once per script root with a placeholder value; each link is then
+    filled in by concatenation, quoted the same way the default path converter quotes it.
+    """
+
+    placeholder = "__link_template__"
+
+    def __init__(self, endpoint, argument):
+        self.endpoint = endpoint
+        self.argument = argument
+        self.parts = {}
+        self.converter = app.url_map.converters["default"](app.url_map)
+
+    def __call__(self, value):
+        parts = self.parts.get(request.script_root)
+        if parts is None:
+            url = url_for(self.endpoint, **{self.argument: self.placeholder})
+            parts = self.parts[request.script_root] = tuple(url.split(self.placeholder))
+        return parts[0] + self.converter.to_url(value) + parts[1]
+
+book_link = LinkTemplate("retrieve_book", "book_id")
+loan_link = LinkTemplate("retrieve_loan", "loan_id")
+webhook_subscription_link = LinkTemplate("retrieve_webhook_subscription", "subscription_id")
+
 def book_resource(book):
     return {
         "type": "book",
@@ -104,7 +816,7 @@ def book_resource(book):
             "author": book["author"]
         },
         "links": {
-            "self": url_for("retrieve_book", book_id=book["id"])
+            "self": book_link(book["id"])
         }
     }
 
@@ -122,15 +834,18 @@ def loan_resource(loan):
                     "id": loan["book_id"]
                 },
                 "links": {
-                    "related": url_for("retrieve_book", book_id=loan["book_id"])
+                    "related": book_link(loan["book_id"])
                 }
             }
         },
         "links": {
-            "self": url_for("retrieve_loan", loan_id=loan["id"])
+            "self": loan_link(loan["id"])
         }
     }
 
+def loan_resource_json(loan):
+    return loan.resource_json(loan_link(loan["id"]), book_link(loan["book_id"]))
+
 def webhook_subscription_resource(subscription):
     return {
         "type": "webhook-subscription",
@@ -138,76 +853,507 @@ def webhook_subscription_resource(subscription):
         "attributes": {
             "url": subscription["url"],
             "events": subscription["events"],
+            "batch": subscription["batch"],
             "secret": subscription["secret"],
             "created_at": subscription["created_at"],
         },
-        "links": {"self": url_for("retrieve_webhook_subscription", subscription_id=subscription["id"])},
+        "links": {"self": webhook_subscription_link(subscription["id"])},
     }
 
 def webhook_event_resource(event):
-    return {"type": "webhook-event", "id": event["id"], "attributes": event}
+    return {"type": "webhook-event", "id": event["id"], "attributes": event.to_dict()}
 
 def webhook_delivery_resource(delivery):
-    return {"type": "webhook-delivery", "id": delivery["id"], "attributes": delivery}
+    return {"type": "webhook-delivery", "id": delivery["id"], "attributes": delivery.to_dict()}
+
+def webhook_dead_letter_resource(dead_letter):
+    return {"type": "webhook-dead-letter", "id": dead_letter["id"], "attributes": dead_letter}
 
 def iso_timestamp():
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
+class HistoryLog:
+    """Bounded history of recent records, each stamped with a consecutive ``seq`` number.
+
+    The history and its numbering belong to one process: with several workers, each holds
+    only the records it produced itself, and numbers them independently.
+
+    Appends are O(1) and push the oldest record out once ``capacity`` is reached. Because
+    sequence numbers have no gaps, the records after ``seq`` are exactly the newest
+    ``latest - seq`` entries, so ``since`` only touches the tail a poller has not seen.
+    """
+
+    def __init__(self, capacity):
+        self.records = deque(maxlen=capacity)
+        self.latest = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, record):
+        with self.lock:
+            self.latest += 1
+            record.seq = self.latest
+            self.records.append(record)
+        return record
+
+    def since(self, seq=0):
+        """Return the retained records newer than ``seq``, newest first."""
+        with self.lock:
+            count = min(len(self.records), max(0, self.latest - seq))
+            return list(itertools.islice(reversed(self.records), count))
+
+webhook_events = HistoryLog(WEBHOOK_HISTORY_LIMIT)
+webhook_deliveries = HistoryLog(WEBHOOK_HISTORY_LIMIT)
+
+class StreamClient:
+    """Bounded buffer of events waiting to be written to one server-sent events connection."""
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.events = deque()
+        self.overflowed = False
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) >= self.buffer_size:
+                self.overflowed = True
+            else:
+                self.events.append(event)
+            self.condition.notify()
+
+    def take(self, timeout):
+        """Wait up to ``timeout`` seconds and return ``(events, overflowed)``."""
+        with self.condition:
+            if not self.events and not self.overflowed:
+                self.condition.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+            return events, self.overflowed
+
+class EventStream:
+    """Fans recorded events out to connected ``/events/stream`` clients.
+
+    Publishing never blocks on a client: each one has its own bounded buffer, and a consumer
+    too slow to keep up is disconnected once its buffer overflows. It then reconnects with
+    ``Last-Event-ID`` and catches up from the event history.
+    """
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        client = StreamClient(self.buffer_size)
+        with self.lock:
+            self.clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            self.clients.discard(client)
+
+    def publish(self, event):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.put(event)
+
+event_stream = EventStream(EVENT_STREAM_BUFFER_SIZE)
+event_lock = threading.Lock()
+
 def record_event(event_type, data):
-    event = {"id": str(uuid4()), "type": event_type, "created_at": iso_timestamp(), "data": data}
-    webhook_events.insert(0, event)
-    del webhook_events[WEBHOOK_HISTORY_LIMIT:]
+    event = WebhookEvent(id=str(uuid4()), type=event_type, created_at=iso_timestamp(), data=data)
+    # Stream clients skip sequence numbers they have already passed, so publish in seq order.
+    with event_lock:
+        webhook_events.append(event)
+        event_stream.publish(event)
     return event
 
 def sign_payload(secret, payload_bytes):
     return hmac.new(secret.encode(), payload_bytes, hashlib.sha256).hexdigest()
 
-def dispatch_webhook(subscription, event):
-    payload = json.dumps(event, separators=(",", ":"), sort_keys=True).encode()
+class ConnectionPool:
+    """Keeps persistent HTTP/1.1 connections per (scheme, host, port) for webhook POSTs.
+
+    At most ``max_per_host`` connections to one host are open at a time; idle connections
+    older than ``idle_timeout`` seconds are closed instead of being reused.
+    """
+
+    def __init__(self, max_per_host, idle_timeout, timeout):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+
+    def _evict_expired(self, key, now):
+        connections = self.idle.get(key, [])
+        while connections and now - connections[0][1] > self.idle_timeout:
+            connections.pop(0)[0].close()
+
+    def _acquire(self, key):
+        with self.lock:
+            slot = self.slots.setdefault(key, threading.BoundedSemaphore(self.max_per_host))
+        if not slot.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No free connection to {key[1]}:{key[2]}")
+        with self.lock:
+            self._evict_expired(key, time.monotonic())
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()[0], True
+        scheme, host, port = key
+        connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection_class(host, port, timeout=self.timeout), False
+
+    def _release(self, key, connection, reusable):
+        with self.lock:
+            if reusable:
+                self.idle.setdefault(key, []).append((connection, time.monotonic()))
+            else:
+                connection.close()
+            self._evict_expired(key, time.monotonic())
+        self.slots[key].release()
+
+    def post(self, url, body, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Unsupported webhook URL: {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        connection, reused = self._acquire(key)
+        reusable = False
+        try:
+            try:
+                connection.request("POST", path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # The receiver closed an idle keep-alive connection; retry once on a fresh one.
+                connection.close()
+                connection.request("POST", path, body=body, headers=headers)
+                response = connection.getresponse()
+            response_body = response.read()
+            reusable = not response.will_close
+            return response.status, response_body
+        finally:
+            self._release(key, connection, reusable)
+
+    def close_all(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            self.idle.clear()
+
+webhook_connection_pool = ConnectionPool(WEBHOOK_POOL_MAX_PER_HOST, WEBHOOK_POOL_IDLE_TIMEOUT, WEBHOOK_TIMEOUT)
+
+def dispatch_webhook(subscription, event, attempt=1):
+    """Deliver one event, or a list of events for batched subscriptions, as a signed JSON body."""
+    start = time.perf_counter()
+    if isinstance(event, list):
+        payload = ("[" + ",".join(item.to_json() for item in event) + "]").encode()
+    else:
+        payload = event.to_json().encode()
     signature = sign_payload(subscription["secret"], payload)
-    req = urlrequest.Request(
-        subscription["url"],
-        data=payload,
-        headers={
-            "Content-Type": "application/json",
-            "User-Agent": "LibraryAPI-Webhook/1.0",
-            "X-Webhook-Event": event["type"],
-            "X-Webhook-Signature": signature,
-        },
-        method="POST",
-    )
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "LibraryAPI-Webhook/1.0",
+        "X-Webhook-Signature": signature,
+    }
+    if isinstance(event, list):
+        headers["X-Webhook-Event"] = "batch"
+        headers["X-Webhook-Batch-Size"] = str(len(event))
+    else:
+        headers["X-Webhook-Event"] = event["type"]
     status_code = None
     success = False
     response_body = ""
     try:
-        with urlrequest.urlopen(req, timeout=5) as resp:
-            status_code = resp.status
-            response_body = resp.read(256).decode(errors="ignore")
-            success = 200 <= status_code < 300
-    except error.HTTPError as exc:
-        status_code = exc.code
-        response_body = exc.read(256).decode(errors="ignore")
+        status_code, response_bytes = webhook_connection_pool.post(subscription["url"], payload, headers)
+        response_body = response_bytes[:256].decode(errors="ignore")
+        success = 200 <= status_code < 300
     except Exception as exc:
         response_body = str(exc)
-    delivery = {
+    delivery = Delivery(
+        id=str(uuid4()),
+        subscription_id=subscription["id"],
+        attempt=attempt,
+        attempted_at=iso_timestamp(),
+        status_code=status_code,
+        success=success,
+        response_sample=response_body,
+    )
+    if isinstance(event, list):
+        delivery.event_ids = [item.id for item in event]
+    else:
+        delivery.event_id = event.id
+    webhook_deliveries_total.inc("success" if success else "failure")
+    webhook_dispatch_latency.observe(time.perf_counter() - start)
+    return webhook_deliveries.append(delivery)
+
+def is_retryable_status(status_code):
+    return status_code is None or status_code in (408, 429) or status_code >= 500
+
+def retry_delay(attempt):
+    delay = min(WEBHOOK_RETRY_MAX_DELAY, WEBHOOK_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+def dead_letter(subscription, event, delivery):
+    record = {
         "id": str(uuid4()),
         "subscription_id": subscription["id"],
-        "event_id": event["id"],
-        "attempted_at": iso_timestamp(),
-        "status_code": status_code,
-        "success": success,
-        "response_sample": response_body,
+        "event": event,
+        "attempts": delivery["attempt"],
+        "last_status_code": delivery["status_code"],
+        "last_response_sample": delivery["response_sample"],
+        "dead_lettered_at": iso_timestamp(),
     }
-    webhook_deliveries.insert(0, delivery)
-    del webhook_deliveries[WEBHOOK_HISTORY_LIMIT:]
-    return success
+    with dead_letter_lock:
+        webhook_dead_letters[record["id"]] = record
+        while len(webhook_dead_letters) > WEBHOOK_DEAD_LETTER_LIMIT:
+            webhook_dead_letters.pop(next(iter(webhook_dead_letters)))
+    return record
 
-def emit_event(event_type, data):
-    event = record_event(event_type, data)
+def handle_failed_delivery(subscription, event, delivery):
+    attempt = delivery["attempt"]
+    if attempt < WEBHOOK_MAX_ATTEMPTS and is_retryable_status(delivery["status_code"]):
+        if webhook_retry_scheduler.schedule(retry_delay(attempt), subscription, event, attempt + 1):
+            return
+    dead_letter(subscription, event, delivery)
+
+class WebhookDispatcher:
+    """Delivers webhooks from a bounded worker pool so request handlers never wait on receivers.
+
+    Each subscription has at most ``per_subscription_limit`` deliveries in flight; anything
+    beyond that waits in a per-subscription backlog and is released as earlier deliveries finish.
+    """
+
+    def __init__(self, workers, per_subscription_limit):
+        self.workers = workers
+        self.per_subscription_limit = per_subscription_limit
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.backlog = {}
+        self.threads = []
+        self.closed = False
+
+    def start(self):
+        with self.lock:
+            if self.threads or self.closed:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"webhook-worker-{index}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, subscription, event, attempt=1):
+        if not self.threads:
+            self.start()
+        job = (subscription, event, attempt)
+        subscription_id = subscription["id"]
+        with self.lock:
+            if self.closed:
+                return False
+            if self.in_flight.get(subscription_id, 0) < self.per_subscription_limit:
+                self.in_flight[subscription_id] = self.in_flight.get(subscription_id, 0) + 1
+                self.jobs.put(job)
+            else:
+                self.backlog.setdefault(subscription_id, deque()).append(job)
+        return True
+
+    def _release(self, subscription_id):
+        with self.lock:
+            pending = self.backlog.get(subscription_id)
+            if pending:
+                self.jobs.put(pending.popleft())
+                if not pending:
+                    del self.backlog[subscription_id]
+                return
+            remaining = self.in_flight.get(subscription_id, 1) - 1
+            if remaining:
+                self.in_flight[subscription_id] = remaining
+            else:
+                self.in_flight.pop(subscription_id, None)
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            subscription, event, attempt = job
+            try:
+                delivery = dispatch_webhook(subscription, event, attempt)
+                if not delivery["success"]:
+                    handle_failed_delivery(subscription, event, delivery)
+            except Exception:
+                app.logger.exception("Webhook delivery to %s failed", subscription["url"])
+            finally:
+                self._release(subscription["id"])
+                self.jobs.task_done()
+
+    def shutdown(self, timeout=None):
+        """Stop accepting events, deliver everything already queued, then stop the workers."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = list(self.threads)
+        if not threads:
+            return
+        self.jobs.join()
+        for _ in threads:
+            self.jobs.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+class RetryScheduler:
+    """Holds failed deliveries in a min-heap keyed by next-attempt time and resubmits them when due."""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def schedule(self, delay, subscription, event, attempt):
+        with self.condition:
+            if self.closed:
+                return False
+            heapq.heappush(self.heap, (time.monotonic() + delay, next(self.sequence), subscription, event, attempt))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="webhook-retry-scheduler", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.heap or self.heap[0][0] > time.monotonic()):
+                    self.condition.wait(self.heap[0][0] - time.monotonic() if self.heap else None)
+                if self.closed:
+                    return
+                _, _, subscription, event, attempt = heapq.heappop(self.heap)
+            if subscription["id"] in webhook_subscriptions:
+                self.dispatcher.submit(subscription, event, attempt)
+
+    def shutdown(self):
+        """Stop the scheduler and return the retries that were still waiting."""
+        with self.condition:
+            self.closed = True
+            pending = [heapq.heappop(self.heap) for _ in range(len(self.heap))]
+            self.condition.notify()
+        return [(subscription, event, attempt) for _, _, subscription, event, attempt in pending]
+
+class WebhookBatcher:
+    """Buffers events for batched subscriptions and hands them to the dispatcher as one delivery.
+
+    A buffer is flushed as soon as it holds ``max_size`` events, or ``linger_seconds`` after
+    its first event arrived, whichever comes first.
+    """
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.condition = threading.Condition()
+        self.buffers = {}
+        self.thread = None
+        self.closed = False
+
+    def add(self, subscription, event):
+        settings = subscription["batch"]
+        subscription_id = subscription["id"]
+        with self.condition:
+            if self.closed:
+                return False
+            buffered = self.buffers.get(subscription_id)
+            if buffered is None:
+                buffered = (subscription, [], time.monotonic() + settings["linger_seconds"])
+                self.buffers[subscription_id] = buffered
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name="webhook-batcher", daemon=True)
+                    self.thread.start()
+                self.condition.notify()
+            buffered[1].append(event)
+            if len(buffered[1]) < settings["max_size"]:
+                return True
+            del self.buffers[subscription_id]
+        self._flush(subscription, buffered[1])
+        return True
+
+    def _flush(self, subscription, events):
+        if subscription["id"] in webhook_subscriptions:
+            self.dispatcher.submit(subscription, events)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                due = [subscription_id for subscription_id, buffered in self.buffers.items() if buffered[2] <= now]
+                if not due:
+                    if self.closed:
+                        return
+                    deadline = min((buffered[2] for buffered in self.buffers.values()), default=None)
+                    self.condition.wait(None if deadline is None else deadline - now)
+                    continue
+                ready = [self.buffers.pop(subscription_id) for subscription_id in due]
+            for subscription, events, _ in ready:
+                self._flush(subscription, events)
+
+    def shutdown(self):
+        """Stop buffering and flush whatever is still waiting to the dispatcher."""
+        with self.condition:
+            self.closed = True
+            ready = list(self.buffers.values())
+            self.buffers.clear()
+            self.condition.notify()
+        for subscription, events, _ in ready:
+            self._flush(subscription, events)
+
+webhook_dispatcher = WebhookDispatcher(WEBHOOK_WORKERS, WEBHOOK_MAX_IN_FLIGHT_PER_SUBSCRIPTION)
+webhook_retry_scheduler = RetryScheduler(webhook_dispatcher)
+webhook_batcher = WebhookBatcher(webhook_dispatcher)
+
+def shutdown_webhooks():
+    webhook_batcher.shutdown()
+    for subscription, event, attempt in webhook_retry_scheduler.shutdown():
+        delivery = {"attempt": attempt - 1, "status_code": None, "response_sample": "Retry pending at shutdown"}
+        dead_letter(subscription, event, delivery)
+    webhook_dispatcher.shutdown()
+    webhook_connection_pool.close_all()
+
+atexit.register(shutdown_webhooks)
+
+def emit_events(changes):
+    """Record ``(event_type, data)`` pairs and queue them for every matching subscriber.
+
+    Only subscriptions that opted into batching receive arrays, through the batcher; the
+    others get one delivery per event, as they always have.
+    """
+    events = [record_event(event_type, data) for event_type, data in changes]
     for subscription in webhook_subscriptions.values():
-        if event_type in subscription["events"]:
-            dispatch_webhook(subscription, event)
-    return event
+        for event in events:
+            if event["type"] not in subscription["events"]:
+                continue
+            if subscription["batch"]:
+                webhook_batcher.add(subscription, event)
+            else:
+                webhook_dispatcher.submit(subscription, event)
+    return events
+
+def emit_event(event_type, data):
+    return emit_events([(event_type, data)])[0]
 
 def normalize_event_list(events):
     if events is None:
@@ -222,15 +1368,137 @@ def normalize_event_list(events):
             normalized.append(event_name)
     return normalized
 
+def normalize_batch_settings(batch):
+    if batch is None or batch is False:
+        return None
+    if batch is True:
+        batch = {}
+    if not isinstance(batch, dict):
+        abort(400, description="Batch must be an object or boolean")
+    max_size = batch.get("max_size", WEBHOOK_BATCH_MAX_SIZE)
+    linger = batch.get("linger_seconds", WEBHOOK_BATCH_LINGER)
+    if isinstance(max_size, bool) or not isinstance(max_size, int) or not 1 <= max_size <= WEBHOOK_BATCH_SIZE_LIMIT:
+        abort(400, description=f"Batch max_size must be an integer between 1 and {WEBHOOK_BATCH_SIZE_LIMIT}")
+    if isinstance(linger, bool) or not isinstance(linger, (int, float)) or not 0 < linger <= WEBHOOK_BATCH_LINGER_LIMIT:
+        abort(400, description=f"Batch linger_seconds must be between 0 and {WEBHOOK_BATCH_LINGER_LIMIT}")
+    return {"max_size": max_size, "linger_seconds": linger}
+
+LOAN_INCLUDES = {"book"}
+
+def include_param(allowed):
+    names = {name.strip() for name in request.args.get("include", "").split(",") if name.strip()}
+    unknown = names - allowed
+    if unknown:
+        abort(400, description="Unsupported include: " + ", ".join(sorted(unknown)))
+    return names
+
+def sparse_fields():
+    """Read JSON:API ``fields[<type>]=a,b`` parameters into a mapping of type to field names."""
+    fields = {}
+    for key, value in request.args.items():
+        if key.startswith("fields[") and key.endswith("]"):
+            fields[key[len("fields["):-1]] = {name.strip() for name in value.split(",") if name.strip()}
+    return fields
+
+def compound_params():
+    return {key: value for key, value in request.args.items() if key == "include" or key.startswith("fields[")}
+
+def sparse_fieldset(resource, fields):
+    wanted = fields.get(resource["type"])
+    if wanted is None:
+        return resource
+    resource["attributes"] = {name: value for name, value in resource["attributes"].items() if name in wanted}
+    if "relationships" in resource:
+        resource["relationships"] = {name: value for name, value in resource["relationships"].items() if name in wanted}
+    return resource
+
+class IncludedBooks:
+    """Collects the distinct books referenced by a set of loans for a compound document."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.book_ids = {}
+
+    def add(self, loan):
+        self.book_ids.setdefault(loan["book_id"], None)
+
+    def resources(self):
+        found = (books.get(book_id) for book_id in self.book_ids)
+        return [sparse_fieldset(book_resource(book), self.fields) for book in found if book]
+
+def loan_document_resource(loan, fields, included=None):
+    if included is not None:
+        included.add(loan)
+    return sparse_fieldset(loan_resource(loan), fields)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    response = app.response_class(metrics_registry.render(), mimetype="text/plain")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
 @app.route("/auth/login", methods=["POST"])
 def login():
     payload = request.get_json(force=True)
     require_fields(payload, ["username", "password"])
-    record = users.get(payload["username"])
-    if not record or record["password"] != payload["password"]:
+    username, password = payload["username"], payload["password"]
+    if not isinstance(username, str) or not isinstance(password, str):
+        abort(400, description="Username and password must be strings")
+    if failed_logins.seen(username, password):
+        abort(401, description="Invalid credentials")
+    record = users.get(username)
+    stored = record["password"] if record else None
+    try:
+        valid = password_hasher.verify(password, stored)
+        if valid and needs_rehash(stored, PASSWORD_HASH_ITERATIONS):
+            users[username] = {"password": password_hasher.hash(password)}
+    except HasherBusy:
+        abort(503, description="Too many logins in progress", retry_after=1)
+    if not valid:
+        failed_logins.add(username, password)
         abort(401, description="Invalid credentials")
-    token = encode_jwt({"sub": payload["username"], "exp": int(time.time()) + 3600})
-    return json_response(envelope({"token": token}, links={"self": url_for("login")}), cache_control="no-store")
+    return json_response(envelope(issue_tokens(username), links={"self": url_for("login")}), cache_control="no-store")
+
+@app.route("/auth/refresh", methods=["POST"])
+def refresh():
+    payload = request.get_json(force=True)
+    require_fields(payload, ["refresh_token"])
+    if not isinstance(payload["refresh_token"], str):
+        abort(400, description="refresh_token must be a string")
+    # Each refresh token works once; popping it means concurrent reuse can only succeed once.
+    record = refresh_tokens.pop(refresh_token_id(payload["refresh_token"]), None)
+    if record is None or record["expires_at"] < time.time():
+        abort(401, description="Invalid refresh token")
+    return json_response(envelope(issue_tokens(record["sub"]), links={"self": url_for("refresh")}), cache_control="no-store")
+
+@app.route("/auth/logout", methods=["POST"])
+def logout():
+    token = request_token()
+    if "jti" in token:
+        revoke_token(token)
+    payload = request.get_json(silent=True)
+    refresh_token = payload.get("refresh_token") if isinstance(payload, dict) else None
+    if isinstance(refresh_token, str):
+        record = refresh_tokens.get(refresh_token_id(refresh_token))
+        # Only the caller's own refresh tokens can be revoked this way.
+        if record is not None and record["sub"] == token.get("sub"):
+            refresh_tokens.pop(refresh_token_id(refresh_token), None)
+    response = app.response_class(status=204)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+@app.route("/auth/keys", methods=["POST"])
+def rotate_keys():
+    if authenticate_request() != "admin":
+        abort(403, description="Only admin can rotate signing keys")
+    payload = request.get_json(silent=True)
+    kid = payload.get("kid") if isinstance(payload, dict) else None
+    if kid is not None and not isinstance(kid, str):
+        abort(400, description="kid must be a string")
+    kid, previous_kid, retires_at = rotate_signing_key(kid)
+    data = {"kid": kid, "previous_kid": previous_kid, "previous_kid_expires_at": int(retires_at)}
+    return json_response(envelope(data, links={"self": url_for("rotate_keys")}), status=201)
 
 @app.route("/webhooks/subscriptions", methods=["GET"])
 def list_webhook_subscriptions():
@@ -245,6 +1513,7 @@ def create_webhook_subscription():
     payload = request.get_json(force=True)
     require_fields(payload, ["url"])
     events = normalize_event_list(payload.get("events"))
+    batch = normalize_batch_settings(payload.get("batch"))
     subscription_id = str(uuid4())
     secret = payload.get("secret") or uuid4().hex
     subscription = {
@@ -252,6 +1521,7 @@ def create_webhook_subscription():
         "url": payload["url"],
         "secret": secret,
         "events": events,
+        "batch": batch,
         "created_at": iso_timestamp(),
     }
     webhook_subscriptions[subscription_id] = subscription
@@ -278,24 +1548,190 @@ def delete_webhook_subscription(subscription_id):
     response.headers["Cache-Control"] = "no-store"
     return response
 
+def history_response(log, endpoint, collection, to_resource, to_json):
+    """List ``log`` newest first, or only the records after ``?since=<seq>``.
+
+    ``links.next`` is the URL to poll for whatever arrives after this response. A ``since``
+    ahead of the log was issued before the process restarted and numbering began again, so
+    the poller is reset: it gets the whole retained log and a ``next`` link at the new latest.
+
+    Each process keeps and numbers its own log, so a seq from one worker means nothing to
+    another: with several workers ``since`` is refused and no ``next`` link is given.
+    """
+    if WORKER_COUNT > 1 and "since" in request.args:
+        abort(501, description="since polling needs a single worker process")
+    since_param = request.args.get("since", "0")
+    try:
+        since = int(since_param)
+    except ValueError:
+        abort(400, description="Invalid since parameter")
+    if since < 0:
+        abort(400, description="Invalid since parameter")
+    # Read the version before the records so the ETag never claims more than the body holds.
+    latest = log.latest
+    links = {"self": url_for(endpoint, since=since) if "since" in request.args else url_for(endpoint)}
+    if WORKER_COUNT == 1:
+        links["next"] = url_for(endpoint, since=latest)
+    if since > latest:
+        since = 0
+    records = log.since(since)
+    # Workers can reach the same latest with different histories, so the ETag names the process.
+    version = (collection, PROCESS_ID, latest)
+    if len(records) > STREAMING_THRESHOLD:
+        return streamed_response(records, to_json, links, version, max_age=5, meta={"latest_seq": latest})
+
+    def build():
+        resources = [to_resource(record) for record in records]
+        meta = {"count": len(resources), "latest_seq": latest}
+        return envelope(resources, links=links, meta=meta)
+    return cached_response(build, version, max_age=5)
+
 @app.route("/webhooks/events", methods=["GET"])
 def list_webhook_events():
     authenticate_request()
-    resources = [webhook_event_resource(event) for event in webhook_events]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_webhook_events")}, meta=meta), max_age=5)
+    return history_response(
+        webhook_events, "list_webhook_events", "webhook_events", webhook_event_resource, WebhookEvent.resource_json
+    )
 
 @app.route("/webhooks/deliveries", methods=["GET"])
 def list_webhook_deliveries():
     authenticate_request()
-    resources = [webhook_delivery_resource(delivery) for delivery in webhook_deliveries]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_webhook_deliveries")}, meta=meta), max_age=5)
+    return history_response(
+        webhook_deliveries, "list_webhook_deliveries", "webhook_deliveries", webhook_delivery_resource,
+        Delivery.resource_json,
+    )
+
+def server_sent_event(event):
+    return f"id: {event.seq}\nevent: {event.type}\ndata: {event.to_json()}\n\n"
+
+@app.route("/events/stream", methods=["GET"])
+def stream_events():
+    """Push webhook events to the client as server-sent events.
+
+    Events, their seq numbers and the connected clients all live in this process, so a client
+    would only see writes served by its own worker, and its Last-Event-ID would mean nothing
+    to another one. The stream is therefore refused when serve.py runs several workers.
+    """
+    authenticate_request()
+    if WORKER_COUNT > 1:
+        abort(501, description="The event stream needs a single worker process; subscribe a webhook instead")
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_event_id", ""))
+    try:
+        last_seq = int(last_event_id) if last_event_id else webhook_events.latest
+    except ValueError:
+        abort(400, description="Invalid Last-Event-ID")
+    if last_seq > webhook_events.latest:
+        # An id ahead of the history was issued before this process restarted; replay what is kept.
+        last_seq = 0
+
+    def generate():
+        seen = last_seq
+        # Subscribe before replaying so nothing recorded in between is lost; seq drops repeats.
+        client = event_stream.subscribe()
+        try:
+            yield f"retry: {EVENT_STREAM_RETRY_MS}\n\n"
+            for event in reversed(webhook_events.since(seen)):
+                seen = event.seq
+                yield server_sent_event(event)
+            while True:
+                events, overflowed = client.take(EVENT_STREAM_HEARTBEAT)
+                if overflowed:
+                    return
+                if not events:
+                    yield ": keep-alive\n\n"
+                    continue
+                chunk = "".join(server_sent_event(event) for event in events if event.seq > seen)
+                seen = max(seen, events[-1].seq)
+                if chunk:
+                    yield chunk
+        finally:
+            event_stream.unsubscribe(client)
+    response = app.response_class(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@app.route("/webhooks/dead-letters", methods=["GET"])
+def list_webhook_dead_letters():
+    authenticate_request()
+    with dead_letter_lock:
+        resources = [webhook_dead_letter_resource(record) for record in webhook_dead_letters.values()]
+    meta = {"count": len(resources), "max_attempts": WEBHOOK_MAX_ATTEMPTS}
+    return json_response(envelope(resources, links={"self": url_for("list_webhook_dead_letters")}, meta=meta))
+
+@app.route("/webhooks/dead-letters/replay", methods=["POST"])
+def replay_webhook_dead_letters():
+    authenticate_request()
+    payload = request.get_json(force=True, silent=True) or {}
+    if not isinstance(payload, dict):
+        abort(400, description="Body must be an object")
+    requested_ids = payload.get("ids")
+    if requested_ids is not None and not isinstance(requested_ids, list):
+        abort(400, description="Ids must be a list")
+    if requested_ids is not None and not all(isinstance(dead_letter_id, str) for dead_letter_id in requested_ids):
+        abort(400, description="Ids must be strings")
+    with dead_letter_lock:
+        if requested_ids is None:
+            requested_ids = list(webhook_dead_letters)
+        replayable = []
+        skipped = []
+        for dead_letter_id in requested_ids:
+            record = webhook_dead_letters.get(dead_letter_id)
+            subscription = webhook_subscriptions.get(record["subscription_id"]) if record else None
+            if subscription is None:
+                skipped.append(dead_letter_id)
+                continue
+            webhook_dead_letters.pop(dead_letter_id)
+            replayable.append((dead_letter_id, subscription, record["event"]))
+    replayed = []
+    for dead_letter_id, subscription, event in replayable:
+        webhook_dispatcher.submit(subscription, event)
+        replayed.append(dead_letter_id)
+    meta = {"replayed_count": len(replayed), "skipped_count": len(skipped)}
+    data = {"replayed": replayed, "skipped": skipped}
+    return json_response(envelope(data, links={"self": url_for("replay_webhook_dead_letters")}, meta=meta), status=202)
+
+def books_after_cursor(query_param, normalized_query):
+    after, limit = cursor_params()
+
+    def build():
+        if len(normalized_query) >= 3:
+            candidates = book_keys.ordered(book_index.search(normalized_query))
+            pairs = (pair for pair in candidates if pair[0] > after)
+        else:
+            pairs = book_keys.iter_after(after)
+        matches = (
+            (key, book)
+            for key, book in ((key, books.get(book_id)) for key, book_id in pairs)
+            if book and (not normalized_query or book_matches(book, normalized_query))
+        )
+        page_books, next_cursor = cursor_page(matches, limit)
+        resources = [book_resource(book) for book in page_books]
+        meta = {"count": len(resources), "limit": limit}
+        if query_param:
+            meta["query"] = query_param
+
+        def cursor_link(cursor):
+            params = {}
+            if query_param:
+                params["q"] = query_param
+            if cursor:
+                params["after"] = cursor
+            params["limit"] = limit
+            return url_for("list_books", **params)
+        links = {"self": cursor_link(request.args.get("after")), "first": cursor_link(None)}
+        if next_cursor:
+            links["next"] = cursor_link(next_cursor)
+        return envelope(resources, links=links, meta=meta)
+    return cached_response(build, ("books", collection_versions["books"]))
 
 @app.route("/books", methods=["GET"])
 def list_books():
     authenticate_request()
     query_param = request.args.get("q", "")
+    normalized_query = query_param.strip().lower()
+    if wants_cursor_pagination():
+        return books_after_cursor(query_param, normalized_query)
     page_param = request.args.get("page", "1")
     size_param = request.args.get("page_size", "10")
     try:
@@ -305,130 +1741,379 @@ def list_books():
         abort(400, description="Invalid pagination parameters")
     if page < 1 or page_size < 1 or page_size > 100:
         abort(400, description="Invalid pagination parameters")
-    normalized_query = query_param.strip().lower()
-    filtered_books = []
-    for book in books.values():
-        if not normalized_query or normalized_query in book["title"].lower() or normalized_query in book["author"].lower():
-            filtered_books.append(book)
-    total_items = len(filtered_books)
-    if total_items == 0 and page != 1:
-        abort(404, description="Page not found")
-    total_pages = max(1, (total_items + page_size - 1) // page_size) if total_items else 1
-    if total_items > 0 and page > total_pages:
-        abort(404, description="Page not found")
-    start = (page - 1) * page_size
-    end = start + page_size
-    paginated_books = filtered_books[start:end]
-    resources = [book_resource(book) for book in paginated_books]
-    meta = {
-        "count": len(resources),
-        "total_count": total_items,
-        "page": page,
-        "page_size": page_size,
-        "total_pages": total_pages,
-    }
-    if query_param:
-        meta["query"] = query_param
 
-    def page_link(target_page):
-        params = {}
+    def build():
+        if not normalized_query:
+            filtered_books = None
+            total_items = len(books)
+        else:
+            if len(normalized_query) < 3:
+                candidates = books.values()
+            else:
+                candidates = (books.get(book_id) for _, book_id in book_keys.ordered(book_index.search(normalized_query)))
+            filtered_books = [book for book in candidates if book and book_matches(book, normalized_query)]
+            total_items = len(filtered_books)
+        if total_items == 0 and page != 1:
+            abort(404, description="Page not found")
+        total_pages = max(1, (total_items + page_size - 1) // page_size) if total_items else 1
+        if total_items > 0 and page > total_pages:
+            abort(404, description="Page not found")
+        start = (page - 1) * page_size
+        end = start + page_size
+        if filtered_books is None:
+            paginated_books = [book for book in map(books.get, book_keys.slice(start, end)) if book]
+        else:
+            paginated_books = filtered_books[start:end]
+        resources = [book_resource(book) for book in paginated_books]
+        meta = {
+            "count": len(resources),
+            "total_count": total_items,
+            "page": page,
+            "page_size": page_size,
+            "total_pages": total_pages,
+        }
         if query_param:
-            params["q"] = query_param
-        params["page"] = target_page
-        params["page_size"] = page_size
-        return url_for("list_books", **params)
-    links = {"self": page_link(page), "first": page_link(1), "last": page_link(total_pages)}
-    if page > 1:
-        links["prev"] = page_link(page - 1)
-    if total_items > page * page_size:
-        links["next"] = page_link(page + 1)
-    return cached_response(envelope(resources, links=links, meta=meta))
+            meta["query"] = query_param
+
+        def page_link(target_page):
+            params = {}
+            if query_param:
+                params["q"] = query_param
+            params["page"] = target_page
+            params["page_size"] = page_size
+            return url_for("list_books", **params)
+        links = {"self": page_link(page), "first": page_link(1), "last": page_link(total_pages)}
+        if page > 1:
+            links["prev"] = page_link(page - 1)
+        if total_items > page * page_size:
+            links["next"] = page_link(page + 1)
+        return envelope(resources, links=links, meta=meta)
+    return cached_response(build, ("books", collection_versions["books"]))
 
 @app.route("/books", methods=["POST"])
 def create_book():
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["title", "author"])
+    require_strings(payload, ["title", "author"])
     book_id = str(uuid4())
-    book = {"id": book_id, "title": payload["title"], "author": payload["author"]}
-    books[book_id] = book
+    book = Book(id=book_id, title=payload["title"], author=payload["author"], revision=1)
+    with storage.transaction():
+        books[book_id] = book
+        record_change("books", book_id)
     resource = book_resource(book)
     location = resource["links"]["self"]
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
 
+def parse_batch(payload, fields, exists, check_item=None, check_delete=None):
+    """Validate a batch body in one pass and return its operations plus per-item errors.
+
+    The body holds optional ``create``, ``update`` (items with an ``id``) and ``delete`` (ids)
+    lists. Every item is checked so the caller can reject the whole batch with all problems.
+    """
+    if not isinstance(payload, dict):
+        abort(400, description="Batch must be an object")
+    operations = {}
+    for op in ("create", "update", "delete"):
+        items = payload.get(op, [])
+        if not isinstance(items, list):
+            abort(400, description=f"Batch {op} must be a list")
+        operations[op] = items
+    total = sum(len(items) for items in operations.values())
+    if total < 1 or total > BATCH_MAX_ITEMS:
+        abort(400, description=f"Batch must contain between 1 and {BATCH_MAX_ITEMS} items")
+    seen = set()
+
+    def check_target(item_id):
+        if not isinstance(item_id, str):
+            return "Id must be a string"
+        if item_id in seen:
+            return "Id appears more than once in the batch"
+        seen.add(item_id)
+        if not exists(item_id):
+            return "Not found"
+        return None
+
+    errors = []
+    for op, required in (("create", fields), ("update", ["id"] + fields)):
+        for index, item in enumerate(operations[op]):
+            if not isinstance(item, dict):
+                detail = "Item must be an object"
+            elif missing_fields(item, required):
+                detail = "Missing fields: " + ", ".join(missing_fields(item, required))
+            elif non_string_fields(item, fields):
+                detail = "Fields must be strings: " + ", ".join(non_string_fields(item, fields))
+            else:
+                detail = (check_target(item["id"]) if op == "update" else None) or (check_item and check_item(item))
+            if detail:
+                errors.append({"op": op, "index": index, "detail": detail})
+    for index, item_id in enumerate(operations["delete"]):
+        detail = check_target(item_id) or (check_delete and check_delete(item_id))
+        if detail:
+            errors.append({"op": "delete", "index": index, "detail": detail})
+    return operations, errors
+
+def batch_result(op, status, resource=None, item_id=None):
+    if resource is None:
+        return {"op": op, "status": status, "id": item_id}
+    return {"op": op, "status": status, "data": resource}
+
+def book_loans_conflict(book_id):
+    count = loan_groups["book_id"].count(book_id)
+    if count:
+        return f"Book has {count} loan(s); delete them first"
+    return None
+
+@app.route("/books:batch", methods=["POST"])
+def batch_books():
+    authenticate_request()
+    payload = request.get_json(force=True)
+    with storage.transaction():
+        # Catch up with loans other workers wrote, so the conflict check sees every one of them.
+        apply_changes()
+        operations, errors = parse_batch(
+            payload, ["title", "author"], books.__contains__, check_delete=book_loans_conflict
+        )
+        if errors:
+            return json_response({"errors": errors}, status=422)
+        created = {}
+        for item in operations["create"]:
+            book_id = str(uuid4())
+            created[book_id] = Book(id=book_id, title=item["title"], author=item["author"], revision=1)
+        books.update(created)
+        updated = []
+        for item in operations["update"]:
+            book = books[item["id"]]
+            book.update({"title": item["title"], "author": item["author"], "revision": book["revision"] + 1})
+            books[book["id"]] = book
+            updated.append(book)
+        for book_id in operations["delete"]:
+            del books[book_id]
+        record_changes("books", list(created) + [book["id"] for book in updated] + operations["delete"])
+        apply_changes()
+    results = [batch_result("create", 201, book_resource(book)) for book in created.values()]
+    results += [batch_result("update", 200, book_resource(book)) for book in updated]
+    results += [batch_result("delete", 204, item_id=book_id) for book_id in operations["delete"]]
+    meta = {"created": len(created), "updated": len(updated), "deleted": len(operations["delete"])}
+    return json_response(envelope(results, links={"self": url_for("batch_books")}, meta=meta))
+
 @app.route("/books/<book_id>", methods=["GET"])
 def retrieve_book(book_id):
     authenticate_request()
     book = books.get(book_id)
     if not book:
         abort(404, description="Book not found")
-    resource = book_resource(book)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+
+    def build():
+        resource = book_resource(book)
+        return envelope(resource, links={"self": resource["links"]["self"]})
+    return cached_response(build, ("book", book_id, book["revision"]))
 
 @app.route("/books/<book_id>", methods=["PUT"])
 def update_book(book_id):
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["title", "author"])
-    book = books.get(book_id)
-    if not book:
-        abort(404, description="Book not found")
-    book.update({"title": payload["title"], "author": payload["author"]})
+    require_strings(payload, ["title", "author"])
+    with storage.transaction():
+        book = books.get(book_id)
+        if not book:
+            abort(404, description="Book not found")
+        book.update({"title": payload["title"], "author": payload["author"], "revision": book["revision"] + 1})
+        books[book_id] = book
+        record_change("books", book_id)
     resource = book_resource(book)
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
 
 @app.route("/books/<book_id>", methods=["DELETE"])
 def delete_book(book_id):
     authenticate_request()
-    if book_id not in books:
-        abort(404, description="Book not found")
-    books.pop(book_id)
+    with storage.transaction():
+        apply_changes()
+        if book_id not in books:
+            abort(404, description="Book not found")
+        conflict = book_loans_conflict(book_id)
+        if conflict:
+            abort(409, description=conflict)
+        books.pop(book_id)
+        record_change("books", book_id)
     response = app.response_class(status=204)
     response.headers["Cache-Control"] = "no-store"
     return response
 
+def loan_filters():
+    return {field: request.args[field] for field in LOAN_FILTERS if field in request.args}
+
+def loans_response(endpoint, filters, **view_args):
+    """List loans in creation order, narrowed by ``filters`` through the secondary indexes."""
+    paginate = wants_cursor_pagination()
+    if paginate:
+        after, limit = cursor_params()
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+    if filters:
+        candidates = None
+        for field, value in filters.items():
+            ids = loan_groups[field].get(value)
+            candidates = ids if candidates is None else candidates & ids
+        ordered = loan_keys.ordered(candidates)
+        total = len(ordered)
+
+        def pairs_after(key):
+            return (pair for pair in ordered if pair[0] > key)
+    else:
+        total = len(loans)
+        pairs_after = loan_keys.iter_after
+
+    def matching_loans(key):
+        for next_key, loan_id in pairs_after(key):
+            loan = loans.get(loan_id)
+            if loan and all(str(loan[field]) == value for field, value in filters.items()):
+                yield next_key, loan
+    link_params = dict(view_args, **filters, **compound_params())
+    version = ("loans", collection_versions["loans"])
+    if include:
+        version += ("books", collection_versions["books"])
+    if not paginate and total > STREAMING_THRESHOLD:
+        all_loans = (loan for _, loan in matching_loans(0))
+        included = IncludedBooks(fields) if "book" in include else None
+
+        def to_json(loan):
+            if included is None and not fields:
+                return loan_resource_json(loan)
+            return canonical_json(loan_document_resource(loan, fields, included))
+        links = {"self": url_for(endpoint, **link_params)}
+        return streamed_response(all_loans, to_json, links, version, included=included, meta=filters)
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        if not paginate:
+            all_loans = loans.values() if not filters else (loan for _, loan in matching_loans(0))
+            resources = [loan_document_resource(loan, fields, included) for loan in all_loans]
+            meta = {"count": len(resources)}
+            meta.update(filters)
+            links = {"self": url_for(endpoint, **link_params)}
+            return envelope(resources, links=links, meta=meta, included=included and included.resources())
+        page_loans, next_cursor = cursor_page(matching_loans(after), limit)
+        resources = [loan_document_resource(loan, fields, included) for loan in page_loans]
+        meta = {"count": len(resources), "limit": limit}
+        meta.update(filters)
+
+        def cursor_link(cursor):
+            if cursor:
+                return url_for(endpoint, after=cursor, limit=limit, **link_params)
+            return url_for(endpoint, limit=limit, **link_params)
+        links = {"self": cursor_link(request.args.get("after")), "first": cursor_link(None)}
+        if next_cursor:
+            links["next"] = cursor_link(next_cursor)
+        return envelope(resources, links=links, meta=meta, included=included and included.resources())
+    return cached_response(build, version)
+
 @app.route("/loans", methods=["GET"])
 def list_loans():
     authenticate_request()
-    resources = [loan_resource(loan) for loan in loans.values()]
-    meta = {"count": len(resources)}
-    return cached_response(envelope(resources, links={"self": url_for("list_loans")}, meta=meta))
+    return loans_response("list_loans", loan_filters())
+
+@app.route("/books/<book_id>/loans", methods=["GET"])
+def list_book_loans(book_id):
+    authenticate_request()
+    if book_id not in books:
+        abort(404, description="Book not found")
+    filters = loan_filters()
+    filters["book_id"] = book_id
+    return loans_response("list_book_loans", filters, book_id=book_id)
 
 @app.route("/loans", methods=["POST"])
 def create_loan():
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["book_id", "borrower"])
-    if payload["book_id"] not in books:
-        abort(404, description="Book not found")
     loan_id = str(uuid4())
-    loan = {"id": loan_id, "book_id": payload["book_id"], "borrower": payload["borrower"]}
-    loans[loan_id] = loan
+    loan = Loan(id=loan_id, book_id=payload["book_id"], borrower=payload["borrower"], revision=1)
+    with storage.transaction():
+        if payload["book_id"] not in books:
+            abort(404, description="Book not found")
+        loans[loan_id] = loan
+        record_change("loans", loan_id)
     resource = loan_resource(loan)
     location = resource["links"]["self"]
     emit_event("loan.created", {"loan": resource})
     return json_response(envelope(resource, links={"self": location}), status=201, headers={"Location": location})
 
+@app.route("/loans:batch", methods=["POST"])
+def batch_loans():
+    authenticate_request()
+    payload = request.get_json(force=True)
+
+    def check_book(item):
+        return None if item["book_id"] in books else "Book not found"
+    with storage.transaction():
+        operations, errors = parse_batch(payload, ["book_id", "borrower"], loans.__contains__, check_book)
+        if errors:
+            return json_response({"errors": errors}, status=422)
+        created = {}
+        for item in operations["create"]:
+            loan_id = str(uuid4())
+            created[loan_id] = Loan(id=loan_id, book_id=item["book_id"], borrower=item["borrower"], revision=1)
+        loans.update(created)
+        updated = []
+        for item in operations["update"]:
+            loan = loans[item["id"]]
+            loan.update({"book_id": item["book_id"], "borrower": item["borrower"], "revision": loan["revision"] + 1})
+            loans[loan["id"]] = loan
+            updated.append(loan)
+        deleted = [loans.pop(loan_id) for loan_id in operations["delete"]]
+        record_changes("loans", list(created) + [loan["id"] for loan in updated] + operations["delete"])
+        apply_changes()
+    results = []
+    changes = []
+    for op, status, event_type, batch in (
+        ("create", 201, "loan.created", created.values()),
+        ("update", 200, "loan.updated", updated),
+        ("delete", 204, "loan.deleted", deleted),
+    ):
+        for loan in batch:
+            resource = loan_resource(loan)
+            changes.append((event_type, {"loan": resource}))
+            results.append(batch_result(op, status, item_id=loan["id"]) if op == "delete" else batch_result(op, status, resource))
+    emit_events(changes)
+    meta = {"created": len(created), "updated": len(updated), "deleted": len(deleted)}
+    return json_response(envelope(results, links={"self": url_for("batch_loans")}, meta=meta))
+
 @app.route("/loans/<loan_id>", methods=["GET"])
 def retrieve_loan(loan_id):
     authenticate_request()
     loan = loans.get(loan_id)
     if not loan:
         abort(404, description="Loan not found")
-    resource = loan_resource(loan)
-    return cached_response(envelope(resource, links={"self": resource["links"]["self"]}))
+    include = include_param(LOAN_INCLUDES)
+    fields = sparse_fields()
+    version = ("loan", loan_id, loan["revision"])
+    if include:
+        book = books.get(loan["book_id"])
+        version += ("book", loan["book_id"], book["revision"] if book else 0)
+
+    def build():
+        included = IncludedBooks(fields) if "book" in include else None
+        resource = loan_document_resource(loan, fields, included)
+        links = {"self": resource["links"]["self"]}
+        return envelope(resource, links=links, included=included and included.resources())
+    return cached_response(build, version)
 
 @app.route("/loans/<loan_id>", methods=["PUT"])
 def update_loan(loan_id):
     authenticate_request()
     payload = request.get_json(force=True)
     require_fields(payload, ["book_id", "borrower"])
-    if payload["book_id"] not in books:
-        abort(404, description="Book not found")
-    loan = loans.get(loan_id)
-    if not loan:
-        abort(404, description="Loan not found")
-    loan.update({"book_id": payload["book_id"], "borrower": payload["borrower"]})
+    with storage.transaction():
+        if payload["book_id"] not in books:
+            abort(404, description="Book not found")
+        loan = loans.get(loan_id)
+        if not loan:
+            abort(404, description="Loan not found")
+        loan.update({"book_id": payload["book_id"], "borrower": payload["borrower"], "revision": loan["revision"] + 1})
+        loans[loan_id] = loan
+        record_change("loans", loan_id)
     resource = loan_resource(loan)
     emit_event("loan.updated", {"loan": resource})
     return json_response(envelope(resource, links={"self": resource["links"]["self"]}))
@@ -436,9 +2121,11 @@ def update_loan(loan_id):
 @app.route("/loans/<loan_id>", methods=["DELETE"])
 def delete_loan(loan_id):
     authenticate_request()
-    if loan_id not in loans:
-        abort(404, description="Loan not found")
-    loan = loans.pop(loan_id)
+    with storage.transaction():
+        if loan_id not in loans:
+            abort(404, description="Loan not found")
+        loan = loans.pop(loan_id)
+        record_change("loans", loan_id)
     resource = loan_resource(loan)
     emit_event("loan.deleted", {"loan": resource})
     response = app.response_class(status=204)
@@ -0,0 +1,352 @@
+"""Micro-benchmarks for the v6 Library API.
+
+Run from the v6 directory, e.g. ``python bench.py webhooks``.
+"""
+import argparse
+import cProfile
+import gc
+import hashlib
+import hmac
+import http.client
+import json
+import multiprocessing
+import os
+import pstats
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urlrequest
+
+import app
+import bloom
+import codec
+import metrics
+import ratelimit
+import storage
+from records import Loan
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = b'{"ok":true}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_receiver():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ReceiverHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def report(label, elapsed, count):
+    print(f"{label:<28} {count / elapsed:>10.0f} ops/s {elapsed / count * 1e6:>10.1f} us/op")
+
+
+def bench_webhooks(count):
+    server = start_receiver()
+    url = f"http://127.0.0.1:{server.server_port}/hooks"
+    payload = json.dumps({"type": "loan.created", "data": {"id": "loan-1"}}).encode()
+    headers = {"Content-Type": "application/json"}
+
+    start = time.perf_counter()
+    for _ in range(count):
+        req = urlrequest.Request(url, data=payload, headers=headers, method="POST")
+        with urlrequest.urlopen(req, timeout=5) as resp:
+            resp.read()
+    report("urlopen per delivery", time.perf_counter() - start, count)
+
+    pool = app.ConnectionPool(max_per_host=4, idle_timeout=30.0, timeout=5)
+    start = time.perf_counter()
+    for _ in range(count):
+        pool.post(url, payload, headers)
+    report("pooled keep-alive", time.perf_counter() - start, count)
+    pool.close_all()
+    server.shutdown()
+
+
+def bench_auth(count):
+    token = app.encode_jwt({"sub": "admin", "exp": int(time.time()) + 3600})
+    headers = {"Authorization": f"Bearer {token}"}
+    cached_verify = app.verify_jwt
+    with app.app.test_request_context("/books", headers=headers):
+        app.verify_jwt = cached_verify.__wrapped__
+        try:
+            start = time.perf_counter()
+            for _ in range(count):
+                app.authenticate_request()
+            report("authenticate (uncached)", time.perf_counter() - start, count)
+        finally:
+            app.verify_jwt = cached_verify
+
+        cached_verify.cache_clear()
+        start = time.perf_counter()
+        for _ in range(count):
+            app.authenticate_request()
+        report("authenticate (token cache)", time.perf_counter() - start, count)
+
+    signing_input = token.rsplit(".", 1)[0].encode()
+    secret = app.SECRET
+    start = time.perf_counter()
+    for _ in range(count):
+        hmac.new(secret.encode(), signing_input, hashlib.sha256).digest()
+    report("sign (hmac.new per call)", time.perf_counter() - start, count)
+    key = app.signing_key(app.SECRET_KID)
+    start = time.perf_counter()
+    for _ in range(count):
+        app.sign(key, signing_input)
+    report("sign (prebuilt key copy)", time.perf_counter() - start, count)
+
+
+def bench_login(count):
+    # Logins are measured on their own, without the per-IP login quota in the way.
+    app.rate_limiter = None
+    client = app.app.test_client()
+    print(f"PBKDF2-SHA256 at {app.PASSWORD_HASH_ITERATIONS} iterations, {app.PASSWORD_HASH_WORKERS} hashing threads")
+
+    def login(password, logins):
+        for _ in range(logins):
+            client.post("/auth/login", json={"username": "admin", "password": password})
+
+    for clients in (1, 4, 16):
+        threads = [threading.Thread(target=login, args=("admin", count // clients)) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report(f"login, {clients} clients", time.perf_counter() - start, clients * (count // clients))
+
+    login("wrong", 1)
+    start = time.perf_counter()
+    login("wrong", count)
+    report("repeated bad login (cached)", time.perf_counter() - start, count)
+
+
+def bench_codec(count):
+    books = [
+        app.Book(id=f"book-{index}", title=f"Title {index}", author="Nguyễn Nhật Ánh" if index % 4 == 0 else "Doan Gioi", revision=1)
+        for index in range(100)
+    ]
+    with app.app.test_request_context("/books"):
+        for page_size in (10, 100):
+            page = app.envelope(
+                [app.book_resource(book) for book in books[:page_size]],
+                links={"self": app.url_for("list_books", page=1, page_size=page_size)},
+                meta={"count": page_size, "page": 1, "page_size": page_size, "total_count": 100, "total_pages": 1},
+            )
+            expected = codec.stdlib_dumpb(page)
+            for name, (dumpb, _) in sorted(codec.CODECS.items()):
+                assert dumpb(page) == expected, f"{name} output differs from the canonical encoding"
+                start = time.perf_counter()
+                for _ in range(count):
+                    dumpb(page)
+                report(f"/books page of {page_size}, {name}", time.perf_counter() - start, count)
+    if codec.orjson is None:
+        print("orjson is not installed; only the stdlib codec was measured")
+
+
+def bench_links(count):
+    loans = [{"id": f"loan-{index}", "book_id": f"book-{index % 50}", "borrower": "reader"} for index in range(count)]
+    templates = (app.book_link, app.loan_link)
+
+    def serialize(label):
+        start = time.perf_counter()
+        for loan in loans:
+            app.loan_resource(loan)
+        report(label, time.perf_counter() - start, count)
+        profile = cProfile.Profile()
+        profile.runcall(lambda: [app.loan_resource(loan) for loan in loans])
+        pstats.Stats(profile).sort_stats("tottime").print_stats(4)
+
+    with app.app.test_request_context("/loans"):
+        app.book_link = lambda book_id: app.url_for("retrieve_book", book_id=book_id)
+        app.loan_link = lambda loan_id: app.url_for("retrieve_loan", loan_id=loan_id)
+        try:
+            serialize("loan_resource (url_for)")
+        finally:
+            app.book_link, app.loan_link = templates
+        serialize("loan_resource (templates)")
+
+
+def bench_memory(count):
+    def measure(label, build):
+        gc.collect()
+        tracemalloc.start()
+        loans = [build(index) for index in range(count)]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<28} {size / 2 ** 20:>10.1f} MiB {size / count:>10.1f} B/loan")
+        return loans
+
+    measure("dict loans", lambda index: {
+        "id": f"loan-{index}", "book_id": f"book-{index % 1000}", "borrower": "reader", "revision": 1
+    })
+    measure("Loan records", lambda index: Loan(
+        id=f"loan-{index}", book_id=f"book-{index % 1000}", borrower="reader", revision=1
+    ))
+
+    loans = [Loan(id=f"loan-{index}", book_id="book-1", borrower="reader", revision=1) for index in range(min(count, 100000))]
+    with app.app.test_request_context("/loans"):
+        start = time.perf_counter()
+        for loan in loans:
+            app.canonical_json(app.loan_resource(loan))
+        report("serialize via dicts", time.perf_counter() - start, len(loans))
+        start = time.perf_counter()
+        for loan in loans:
+            app.loan_resource_json(loan)
+        report("serialize from slots", time.perf_counter() - start, len(loans))
+
+
+def bench_metrics(count):
+    registry = metrics.Registry()
+    histogram = registry.histogram("bench_seconds", "Benchmark observations.", ("route",))
+    counter = registry.counter("bench_total", "Benchmark increments.", ("route",))
+
+    def observe(observations):
+        for index in range(observations):
+            histogram.observe(index * 1e-6, "/books")
+
+    def increment(observations):
+        for _ in range(observations):
+            counter.inc("/books")
+
+    for label, record in (("histogram observe", observe), ("counter inc", increment)):
+        for threads in (1, 8):
+            workers = [threading.Thread(target=record, args=(count // threads,)) for _ in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            report(f"{label} ({threads} threads)", time.perf_counter() - start, threads * (count // threads))
+    start = time.perf_counter()
+    registry.render()
+    report("render", time.perf_counter() - start, 1)
+
+
+def bench_ratelimit(count):
+    limiters = {"local": ratelimit.LocalRateLimiter()}
+    with tempfile.TemporaryDirectory() as directory:
+        shared_storage = storage.open_storage(f"sqlite:{os.path.join(directory, 'bench.db')}")
+        limiters["shared"] = ratelimit.SharedRateLimiter(shared_storage)
+        for name, limiter in limiters.items():
+            start = time.perf_counter()
+            for index in range(count):
+                limiter.acquire(f"ip:10.0.{index % 256}.{index % 100}", 20.0, 40)
+            report(f"acquire ({name})", time.perf_counter() - start, count)
+        shared_storage.close()
+
+    limiter = ratelimit.LocalRateLimiter()
+    tracemalloc.start()
+    for index in range(count):
+        limiter.acquire(f"sub:user-{index}", 20.0, 40)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'local buckets':<28} {size / count:>10.0f} B/key")
+
+
+def bench_revocation(count):
+    jtis = [f"revoked-{index}" for index in range(1000)]
+    revocation_filter = bloom.BloomFilter(app.REVOCATION_FILTER_CAPACITY)
+    for jti in jtis:
+        revocation_filter.add(jti)
+    unrevoked = [f"live-{index}" for index in range(count)]
+    with tempfile.TemporaryDirectory() as directory:
+        shared_storage = storage.open_storage(f"sqlite:{os.path.join(directory, 'bench.db')}")
+        revoked = shared_storage.table("revoked_tokens", "jti", ("expires_at",))
+        revoked.update({jti: {"expires_at": 0} for jti in jtis})
+        start = time.perf_counter()
+        for jti in unrevoked:
+            jti in revoked
+        report("not revoked (table lookup)", time.perf_counter() - start, count)
+        shared_storage.close()
+    start = time.perf_counter()
+    false_positives = sum(jti in revocation_filter for jti in unrevoked)
+    report("not revoked (bloom filter)", time.perf_counter() - start, count)
+    print(f"{'false positives':<28} {false_positives / count:>10.4%}")
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_server(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            body = json.dumps({"username": "admin", "password": "admin"})
+            connection.request("POST", "/auth/login", body=body, headers={"Content-Type": "application/json"})
+            return json.loads(connection.getresponse().read())["data"]["token"]
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server did not start")
+
+
+def fetch_books(args):
+    port, token, count = args
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers = {"Authorization": f"Bearer {token}"}
+    for _ in range(count):
+        connection.request("GET", "/books?limit=10", headers=headers)
+        connection.getresponse().read()
+    connection.close()
+
+
+def bench_workers(count):
+    cores = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, cores} | {2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores})
+    print(f"{cores} CPU cores available")
+    for workers in worker_counts:
+        port = free_port()
+        with tempfile.TemporaryDirectory() as directory:
+            command = [
+                sys.executable, "serve.py", "--workers", str(workers), "--port", str(port),
+                "--storage", f"sqlite:{os.path.join(directory, 'bench.db')}",
+            ]
+            environment = dict(os.environ, LIBRARY_RATE_LIMIT="off")
+            server = subprocess.Popen(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                token = wait_for_server(port)
+                clients = max(4, workers * 2)
+                jobs = [(port, token, count // clients)] * clients
+                with multiprocessing.Pool(clients) as pool:
+                    start = time.perf_counter()
+                    pool.map(fetch_books, jobs)
+                    report(f"GET /books, {workers} workers", time.perf_counter() - start, clients * (count // clients))
+            finally:
+                server.terminate()
+                server.wait()
+
+
+BENCHMARKS = {"auth": bench_auth, "codec": bench_codec, "links": bench_links, "login": bench_login, "memory": bench_memory, "metrics": bench_metrics, "ratelimit": bench_ratelimit, "revocation": bench_revocation, "webhooks": bench_webhooks, "workers": bench_workers}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("-n", "--count", type=int, default=2000)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args.count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Bloom filter for quick negative membership checks.
+
+A miss is certain; a hit only means the item may be present and has to be confirmed against
+the real set. The filter is sized from the expected number of items and the acceptable false
+positive rate, and hashes each item once, deriving every bit position from that digest.
+"""
+import hashlib
+import math
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def hashes(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+    def add(self, item):
+        first, second = self.hashes(item)
+        for index in range(self.hash_count):
+            position = (first + index * second) % self.size
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        # About half the bits are set in a full filter, so most misses stop after a probe or two.
+        first, second = self.hashes(item)
+        bits = self.bits
+        size = self.size
+        for index in range(self.hash_count):
+            position = (first + index * second) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
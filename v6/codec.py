@@ -0,0 +1,99 @@
+"""JSON codec for the Library API.
+
+``dumps``/``dumpb`` always produce the canonical encoding: compact separators, sorted keys and
+ASCII-only output, byte for byte what ``json.dumps(data, separators=(",", ":"), sort_keys=True)``
+returns. Cached bodies, signed webhook payloads and JWT segments all depend on that.
+
+When orjson is installed it does the encoding and its output is made to match the standard
+library: non-ASCII text is escaped afterwards, and the rare documents whose encoding differs in
+ways that cannot be patched (some floats, NaN, integers beyond 64 bits, non-string keys) are
+re-encoded with the ``json`` module. Set ``LIBRARY_JSON_CODEC=stdlib`` to turn orjson off.
+"""
+import codecs
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def stdlib_dumpb(data, default=None, sort_keys=True):
+    return json.dumps(data, separators=(",", ":"), sort_keys=sort_keys, default=default).encode()
+
+
+def escape_not_ascii(error):
+    return json.dumps(error.object[error.start:error.end])[1:-1], error.end
+
+
+codecs.register_error("json_escape", escape_not_ascii)
+
+
+def ascii_only(body):
+    """Escape non-ASCII text in UTF-8 JSON the way ``json.dumps`` does by default."""
+    escaped = body.decode().encode("ascii", "backslashreplace")
+    # backslashreplace writes \xe9 and \u1ec5 like JSON, except for the \x prefix; characters
+    # beyond the BMP (\U...) need surrogate pairs, and an escaped backslash could be mistaken
+    # for one of these prefixes, so those bodies take the slower exact path.
+    if b"\\U" in escaped or b"\\\\" in body:
+        return body.decode().encode("ascii", "json_escape")
+    return escaped.replace(b"\\x", b"\\u00")
+
+
+DIGITS_TO_ZERO = bytes.maketrans(b"123456789", b"000000000")
+SUSPECT_NUMBERS = (b"0e", b"0.0000", b"null")
+
+
+def differs_from_stdlib(body):
+    """Whether orjson's ``body`` may hold a number the json module would have written differently.
+
+    orjson writes exponents as ``1e16``/``1e-7`` where the json module writes ``1e+16``/``1e-07``,
+    prints ``1e-05`` as ``0.00001``, and turns NaN and infinities into ``null``. Those forms are
+    found with plain substring searches, and only count when they sit outside a string, which
+    an even number of quotes before them shows.
+    """
+    if body[:1] not in (b"{", b"[", b'"') or b'\\"' in body:
+        return True
+    digits = body.translate(DIGITS_TO_ZERO)
+    positions = []
+    for pattern in SUSPECT_NUMBERS:
+        position = digits.find(pattern)
+        while position != -1:
+            positions.append(position)
+            position = digits.find(pattern, position + 1)
+    quotes = 0
+    previous = 0
+    for position in sorted(positions):
+        quotes += body.count(b'"', previous, position)
+        previous = position
+        if quotes % 2 == 0:
+            return True
+    return False
+
+
+def orjson_dumpb(data, default=None, sort_keys=True):
+    try:
+        body = orjson.dumps(data, default=default, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+    except TypeError:
+        return stdlib_dumpb(data, default, sort_keys)
+    if differs_from_stdlib(body):
+        return stdlib_dumpb(data, default, sort_keys)
+    if not body.isascii():
+        body = ascii_only(body)
+    if b"\x7f" in body:
+        body = body.replace(b"\x7f", b"\\u007f")
+    return body
+
+
+CODECS = {"stdlib": (stdlib_dumpb, json.loads)}
+if orjson is not None:
+    CODECS["orjson"] = (orjson_dumpb, orjson.loads)
+
+CODEC = os.environ.get("LIBRARY_JSON_CODEC", "orjson" if orjson is not None else "stdlib")
+if CODEC not in CODECS:
+    raise ValueError(f"Unavailable JSON codec: {CODEC} (choose from {', '.join(sorted(CODECS))})")
+dumpb, loads = CODECS[CODEC]
+
+
+def dumps(data, default=None, sort_keys=True):
+    return dumpb(data, default, sort_keys).decode()
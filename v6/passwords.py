@@ -0,0 +1,102 @@
+"""Password hashing for the Library API.
+
+Passwords are stored as ``pbkdf2_sha256$<iterations>$<salt>$<hash>``. The iteration count is
+the cost: each check takes time proportional to it, so it is kept in the stored value and a
+hash made at an older cost can be upgraded the next time its user signs in.
+
+``PasswordHasher`` runs the hashing on a small thread pool. PBKDF2 releases the GIL, so other
+request threads keep running while logins hash, and a burst of logins can use at most
+``workers`` CPU cores. ``FailedLoginCache`` remembers rejected credentials for a short while,
+so a client retrying the same wrong password is rejected without hashing again.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHM = "pbkdf2_sha256"
+
+
+def hash_password(password, iterations):
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{ALGORITHM}${iterations}${base64.b64encode(salt).decode()}${base64.b64encode(digest).decode()}"
+
+
+def check_password(password, stored):
+    if not stored.startswith(ALGORITHM + "$"):
+        # Rows written before passwords were hashed still hold the plaintext.
+        return hmac.compare_digest(password.encode(), stored.encode())
+    _, iterations, salt, expected = stored.split("$")
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(salt), int(iterations))
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+def needs_rehash(stored, iterations):
+    return not stored.startswith(f"{ALGORITHM}${iterations}$")
+
+
+class HasherBusy(Exception):
+    """Raised when every pool worker is busy and the queue of waiting logins is full."""
+
+
+class PasswordHasher:
+    def __init__(self, iterations, workers=2, queue_limit=16):
+        self.iterations = iterations
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        # Unknown users are checked against this, so they take as long to reject as wrong passwords.
+        self.dummy_hash = hash_password(os.urandom(16).hex(), iterations)
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return self.pool.submit(function, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(hash_password, password, self.iterations)
+
+    def verify(self, password, stored):
+        """Check ``password`` against ``stored``, which is None for an unknown user."""
+        valid = self.run(check_password, password, self.dummy_hash if stored is None else stored)
+        return valid and stored is not None
+
+
+class FailedLoginCache:
+    """Recently rejected username and password pairs, keyed by a keyed hash rather than the password."""
+
+    def __init__(self, ttl=30.0, size=4096):
+        self.ttl = ttl
+        self.size = size
+        self.secret = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, username, password):
+        return hmac.new(self.secret, f"{username}\0{password}".encode(), hashlib.sha256).digest()
+
+    def seen(self, username, password):
+        key = self.key(username, password)
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self.entries[key]
+                return False
+            return True
+
+    def add(self, username, password):
+        key = self.key(username, password)
+        with self.lock:
+            self.entries[key] = time.monotonic() + self.ttl
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
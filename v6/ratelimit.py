@@ -0,0 +1,102 @@
+"""Token-bucket rate limiting for the Library API.
+
+A bucket holds up to ``burst`` tokens and refills at ``rate`` tokens per second; each request
+takes one. Buckets are created on first use and forgotten after ``idle_timeout`` seconds without
+traffic, which must be long enough for any bucket to refill, so forgetting one never grants
+more than a full bucket would.
+
+``LocalRateLimiter`` keeps buckets in process memory. ``SharedRateLimiter`` keeps them in the
+SQLite storage engine so every worker process draws from the same buckets; it stands in for a
+network counter store such as Redis.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class Decision:
+    """Outcome of one ``acquire`` call, with the numbers the RateLimit headers report."""
+
+    __slots__ = ("allowed", "limit", "remaining", "reset", "retry_after")
+
+    def __init__(self, allowed, burst, rate, tokens):
+        self.allowed = allowed
+        self.limit = burst
+        self.remaining = int(tokens)
+        self.reset = math.ceil((burst - tokens) / rate)
+        self.retry_after = 0 if allowed else math.ceil((1 - tokens) / rate)
+
+
+def refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class LocalRateLimiter:
+    """Buckets in a dict kept in least-recently-used order, so idle ones are evicted from the front."""
+
+    def __init__(self, idle_timeout=600.0):
+        self.idle_timeout = idle_timeout
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, rate, burst)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            while self.buckets:
+                oldest_key = next(iter(self.buckets))
+                if self.buckets[oldest_key][1] > now - self.idle_timeout:
+                    break
+                del self.buckets[oldest_key]
+        return Decision(allowed, burst, rate, tokens)
+
+
+class SharedRateLimiter:
+    """Buckets in an SQLite table, updated in one immediate transaction per request."""
+
+    def __init__(self, storage, idle_timeout=600.0, prune_every=1000):
+        self.storage = storage
+        self.idle_timeout = idle_timeout
+        self.prune_every = prune_every
+        self.calls = 0
+        storage.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def acquire(self, key, rate, burst):
+        # Wall-clock time, unlike the local limiter, because the buckets are shared across processes.
+        now = time.time()
+        with self.storage.transaction():
+            row = self.storage.fetchone("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,))
+            tokens = refill(row[0], row[1], now, rate, burst) if row else burst
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.storage.execute(
+                "INSERT INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens, now),
+            )
+            self.calls += 1
+            if self.calls % self.prune_every == 0:
+                self.storage.execute("DELETE FROM rate_limits WHERE updated < ?", (now - self.idle_timeout,))
+        return Decision(allowed, burst, rate, tokens)
+
+
+def open_rate_limiter(mode, storage, idle_timeout=600.0):
+    """Open ``local``, ``shared`` or ``off`` (None) rate limiting."""
+    if mode == "off":
+        return None
+    if mode == "local":
+        return LocalRateLimiter(idle_timeout)
+    if mode == "shared":
+        if not hasattr(storage, "transaction") or not hasattr(storage, "fetchone"):
+            raise ValueError("Shared rate limiting needs SQLite storage")
+        return SharedRateLimiter(storage, idle_timeout)
+    raise ValueError(f"Unsupported rate limit mode: {mode}")
@@ -0,0 +1,131 @@
+"""Slotted record types for the Library API's entities.
+
+Records keep their fields in ``__slots__`` instead of a per-instance ``__dict__``, so a loan
+costs a fraction of the memory of the equivalent dict. They still support the item access the
+app and the storage engines use (``record["field"]``, ``get``, ``update``), which lets them
+stand in wherever plain dicts were used.
+
+``to_json`` and the ``resource_json`` methods write canonical JSON (sorted keys, compact
+separators, ASCII-escaped) straight from the slots, byte for byte what ``json.dumps`` produces
+for the equivalent dicts, without building those dicts first.
+"""
+from json.encoder import encode_basestring_ascii
+
+from codec import dumps
+
+
+def encode_value(value):
+    if type(value) is str:
+        return encode_basestring_ascii(value)
+    return dumps(value, default=record_default)
+
+
+def record_default(value):
+    """``default=`` hook that lets ``json.dumps`` serialize records nested in other data."""
+    if isinstance(value, Record):
+        return value.to_dict()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class Record:
+    """Base class; subclasses list their fields in ``__slots__``.
+
+    Fields named in ``optional`` behave like absent dict keys while they are None.
+    """
+
+    __slots__ = ()
+    optional = ()
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.json_keys = tuple((field, encode_basestring_ascii(field) + ":") for field in sorted(cls.__slots__))
+
+    def __init__(self, **values):
+        for field in self.__slots__:
+            setattr(self, field, values.pop(field, None))
+        if values:
+            raise TypeError(f"{type(self).__name__} has no field(s): {', '.join(sorted(values))}")
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        value = getattr(self, field)
+        if value is None and field in self.optional:
+            raise KeyError(field)
+        return value
+
+    def __setitem__(self, field, value):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.__slots__ and (field not in self.optional or getattr(self, field) is not None)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"{type(self).__name__}({', '.join(f'{field}={self[field]!r}' for field in self.keys())})"
+
+    def keys(self):
+        return [field for field in self.__slots__ if field in self]
+
+    def get(self, field, default=None):
+        return self[field] if field in self else default
+
+    def update(self, values=(), **kwargs):
+        for field, value in dict(values, **kwargs).items():
+            self[field] = value
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.keys()}
+
+    def to_json(self):
+        parts = []
+        for field, key in self.json_keys:
+            value = getattr(self, field)
+            if value is None and field in self.optional:
+                continue
+            parts.append(key + encode_value(value))
+        return "{" + ",".join(parts) + "}"
+
+
+class Book(Record):
+    __slots__ = ("id", "title", "author", "revision")
+
+
+class Loan(Record):
+    __slots__ = ("id", "book_id", "borrower", "revision")
+
+    def resource_json(self, self_link, book_link):
+        """JSON of ``loan_resource(self)``."""
+        return (
+            '{"attributes":{"borrower":' + encode_value(self.borrower) + '},"id":' + encode_value(self.id)
+            + ',"links":{"self":' + encode_basestring_ascii(self_link) + '},"relationships":{"book":{"data":{"id":'
+            + encode_value(self.book_id) + ',"type":"book"},"links":{"related":' + encode_basestring_ascii(book_link)
+            + '}}},"type":"loan"}'
+        )
+
+
+class WebhookEvent(Record):
+    __slots__ = ("id", "seq", "type", "created_at", "data")
+
+    def resource_json(self):
+        return '{"attributes":' + self.to_json() + ',"id":' + encode_value(self.id) + ',"type":"webhook-event"}'
+
+
+class Delivery(Record):
+    __slots__ = (
+        "id", "seq", "subscription_id", "attempt", "attempted_at", "status_code", "success", "response_sample",
+        "event_id", "event_ids",
+    )
+    optional = ("event_id", "event_ids")
+
+    def resource_json(self):
+        return '{"attributes":' + self.to_json() + ',"id":' + encode_value(self.id) + ',"type":"webhook-delivery"}'
@@ -0,0 +1,101 @@
+"""Production launcher: forks N worker processes that share one listening socket.
+
+Workers share state through the SQLite storage engine, and each one replays the storage
+change log before every request, so indexes and cached responses stay consistent. Rate limit
+buckets live in the same database by default, so a client's quota covers every worker.
+Webhook history and ``/events/stream`` are kept per process, so the stream and ``since=``
+polling of the history are refused when more than one worker runs.
+
+    python serve.py --workers 4 --port 8000 --storage sqlite:library.db
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+
+from werkzeug.serving import make_server
+
+
+def stop_worker(signum, frame):
+    raise SystemExit(0)
+
+
+def run_worker(listener, host, port):
+    import app
+
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = make_server(host, port, app.app, threaded=True, fd=listener.fileno())
+    try:
+        server.serve_forever()
+    except SystemExit:
+        pass
+    finally:
+        app.shutdown_webhooks()
+        app.storage.close()
+
+
+def spawn(listener, host, port):
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            run_worker(listener, host, port)
+            code = 0
+        finally:
+            os._exit(code)
+    return pid
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Library API with several worker processes.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--storage", default=os.environ.get("LIBRARY_STORAGE", "sqlite:library.db"))
+    args = parser.parse_args()
+    if args.workers > 1 and args.storage == "memory":
+        parser.error("multiple workers need shared storage, e.g. --storage sqlite:library.db")
+    os.environ["LIBRARY_STORAGE"] = args.storage
+    os.environ["LIBRARY_WORKERS"] = str(args.workers)
+    if args.storage != "memory":
+        os.environ.setdefault("LIBRARY_RATE_LIMIT", "shared")
+
+    # Import once before forking so schema creation, seeding and index loading happen a single
+    # time and every worker inherits the same ETag epoch and keyset keys.
+    import app
+    app.storage.close()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+
+    workers = {spawn(listener, args.host, args.port) for _ in range(args.workers)}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers", file=sys.stderr, flush=True)
+    while workers:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            workers.add(spawn(listener, args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
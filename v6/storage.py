@@ -0,0 +1,373 @@
+"""Storage backends for the Library API.
+
+Every table is exposed as a mutable mapping from primary key to a plain dict, or to the
+table's record type, so the app treats the in-memory and SQLite engines the same way. Values handed out by the SQLite engine
+are copies: write them back with ``table[key] = value`` after changing them.
+
+Each engine also keeps a change log of ``(seq, collection, item_id)`` entries. Processes
+sharing one database replay it to keep their derived indexes and caches in step.
+
+Tables opened with ``ordered=True`` give every row a position when it is first inserted.
+Positions only grow, are never reused and, with SQLite, are stored with the row, so they
+can back pagination cursors that stay valid across restarts and worker processes.
+"""
+import itertools
+import json
+import queue
+import sqlite3
+import threading
+from collections import deque
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
+
+class MemoryStorage:
+    """Keeps every table in a process-local dict; nothing survives a restart."""
+
+    is_new = True
+
+    def __init__(self):
+        self.changes = deque()
+        self.change_sequence = itertools.count(1)
+        self.change_lock = threading.Lock()
+        self.write_lock = threading.RLock()
+
+    def table(self, name, key, columns, json_columns=(), indexes=(), record=dict, ordered=False):
+        return MemoryTable() if ordered else {}
+
+    def transaction(self):
+        # Writers hold this lock from their checks to their last write, so no other writer can
+        # invalidate a check halfway through. Callers validate before writing, so there is
+        # nothing to undo.
+        return self.write_lock
+
+    def delete_before(self, table, column, value):
+        """Delete the rows of ``table`` whose ``column`` is below ``value`` and return how many."""
+        with self.write_lock:
+            keys = [key for key, row in table.items() if row[column] < value]
+            for key in keys:
+                del table[key]
+        return len(keys)
+
+    def append_change(self, collection, item_id):
+        return self.append_changes(collection, [item_id])
+
+    def append_changes(self, collection, item_ids):
+        seq = None
+        with self.change_lock:
+            for item_id in item_ids:
+                seq = next(self.change_sequence)
+                self.changes.append((seq, collection, item_id))
+        return seq
+
+    def changes_since(self, seq):
+        # Only this process reads the log, so entries it has already seen can be dropped.
+        with self.change_lock:
+            while self.changes and self.changes[0][0] <= seq:
+                self.changes.popleft()
+            return list(self.changes)
+
+    def latest_change(self):
+        with self.change_lock:
+            return self.changes[-1][0] if self.changes else 0
+
+    def close(self):
+        pass
+
+
+class MemoryTable(dict):
+    """A dict that also numbers its keys in insertion order."""
+
+    def __init__(self):
+        super().__init__()
+        self.position_of = {}
+        self.next_position = itertools.count(1)
+
+    def __setitem__(self, key, value):
+        if key not in self.position_of:
+            self.position_of[key] = next(self.next_position)
+        super().__setitem__(key, value)
+
+    def update(self, other=(), **kwargs):
+        for key, value in dict(other, **kwargs).items():
+            self[key] = value
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        del self.position_of[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def position(self, key):
+        return self.position_of.get(key)
+
+    def positions(self):
+        return list((position, key) for key, position in self.position_of.items())
+
+
+class SQLiteStorage:
+    """SQLite engine in WAL mode, shared safely by several threads and worker processes.
+
+    Connections are pooled and reused, and every table keeps fixed SQL strings so sqlite3's
+    per-connection statement cache serves them as prepared statements.
+    """
+
+    def __init__(self, path, pool_size=8, change_log_limit=100000):
+        self.path = path
+        self.pool_size = pool_size
+        self.change_log_limit = change_log_limit
+        self.pool = queue.LifoQueue()
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            existing = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS change_log "
+                "(seq INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, item_id TEXT NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS row_positions (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.is_new = existing == 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256
+        )
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        active = getattr(self.local, "transaction", None)
+        if active is not None:
+            yield active
+            return
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if self.pool.qsize() < self.pool_size:
+                self.pool.put(conn)
+            else:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Run every table operation made by this thread inside one SQLite transaction."""
+        with self.connection() as conn:
+            self.local.transaction = conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            finally:
+                self.local.transaction = None
+
+    def execute(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).rowcount
+
+    def fetchone(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql, params=()):
+        with self.connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def table(self, name, key, columns, json_columns=(), indexes=(), record=dict, ordered=False):
+        return SQLiteTable(self, name, key, columns, json_columns, indexes, record, ordered)
+
+    def delete_before(self, table, column, value):
+        """Delete the rows of ``table`` whose ``column`` is below ``value`` in one statement."""
+        return self.execute(f"DELETE FROM {table.name} WHERE {column} < ?", (value,))
+
+    def append_change(self, collection, item_id):
+        with self.connection() as conn:
+            seq = conn.execute("INSERT INTO change_log (collection, item_id) VALUES (?, ?)", (collection, item_id)).lastrowid
+            if seq % 1000 == 0:
+                conn.execute("DELETE FROM change_log WHERE seq <= ?", (seq - self.change_log_limit,))
+        return seq
+
+    def append_changes(self, collection, item_ids):
+        with self.connection() as conn:
+            conn.executemany(
+                "INSERT INTO change_log (collection, item_id) VALUES (?, ?)", [(collection, item_id) for item_id in item_ids]
+            )
+            seq = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            conn.execute("DELETE FROM change_log WHERE seq <= ?", (seq - self.change_log_limit,))
+        return seq
+
+    def changes_since(self, seq):
+        """Return the entries after ``seq``, or None if some of them were already pruned."""
+        rows = self.fetchall("SELECT seq, collection, item_id FROM change_log WHERE seq > ? ORDER BY seq", (seq,))
+        if rows and rows[0][0] != seq + 1:
+            return None
+        return rows
+
+    def latest_change(self):
+        return self.fetchone("SELECT COALESCE(MAX(seq), 0) FROM change_log")[0]
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SQLiteTable(MutableMapping):
+    """One SQLite table seen as a mapping; rows iterate in insertion order.
+
+    Rows are decoded into ``record``, a dict or any type built from the columns as keywords.
+    Ordered tables keep each row's position in a ``position`` column, drawn from the
+    ``row_positions`` counter, which only ever grows, so a deleted row's position is not reused.
+    """
+
+    def __init__(self, storage, name, key, columns, json_columns=(), indexes=(), record=dict, ordered=False):
+        self.storage = storage
+        self.name = name
+        self.record = record
+        self.key = key
+        self.ordered = ordered
+        self.columns = tuple(columns)
+        self.stored_columns = (key,) + tuple(column for column in self.columns if column != key)
+        self.json_columns = set(json_columns)
+        written_columns = self.stored_columns + (("position",) if ordered else ())
+        column_list = ", ".join(self.stored_columns)
+        order = "position" if ordered else "rowid"
+        # An update leaves ``position`` alone, so a row keeps the position of its first insert.
+        updates = ", ".join(f"{column} = excluded.{column}" for column in self.stored_columns[1:])
+        self.select_one_sql = f"SELECT {column_list} FROM {name} WHERE {key} = ?"
+        self.select_all_sql = f"SELECT {column_list} FROM {name} ORDER BY {order}"
+        self.select_keys_sql = f"SELECT {key} FROM {name} ORDER BY {order}"
+        self.exists_sql = f"SELECT 1 FROM {name} WHERE {key} = ?"
+        self.count_sql = f"SELECT COUNT(*) FROM {name}"
+        self.delete_sql = f"DELETE FROM {name} WHERE {key} = ?"
+        self.pop_sql = f"DELETE FROM {name} WHERE {key} = ? RETURNING {column_list}"
+        self.position_sql = f"SELECT position FROM {name} WHERE {key} = ?"
+        self.positions_sql = f"SELECT position, {key} FROM {name} ORDER BY position"
+        self.reserve_sql = "UPDATE row_positions SET value = value + ? WHERE name = ? RETURNING value"
+        self.upsert_sql = (
+            f"INSERT INTO {name} ({', '.join(written_columns)}) VALUES ({', '.join('?' for _ in written_columns)}) "
+            f"ON CONFLICT({key}) DO UPDATE SET {updates}"
+        )
+        other_columns = ", ".join(self.stored_columns[1:])
+        storage.execute(f"CREATE TABLE IF NOT EXISTS {name} ({key} TEXT PRIMARY KEY, {other_columns})")
+        for column in indexes:
+            storage.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_{column} ON {name} ({column})")
+        if ordered:
+            self._add_positions()
+
+    def _add_positions(self):
+        # Tables created before positions existed are numbered in rowid order, which was their
+        # insertion order; the counter then starts past the highest position in use.
+        with self.storage.transaction():
+            existing = {row[1] for row in self.storage.fetchall(f"PRAGMA table_info({self.name})")}
+            if "position" not in existing:
+                self.storage.execute(f"ALTER TABLE {self.name} ADD COLUMN position INTEGER")
+                self.storage.execute(f"UPDATE {self.name} SET position = rowid")
+            self.storage.execute(
+                f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{self.name}_position ON {self.name} (position)"
+            )
+            self.storage.execute("INSERT OR IGNORE INTO row_positions (name, value) VALUES (?, 0)", (self.name,))
+            self.storage.execute(
+                f"UPDATE row_positions SET value = MAX(value, (SELECT COALESCE(MAX(position), 0) FROM {self.name})) "
+                "WHERE name = ?",
+                (self.name,),
+            )
+
+    def _reserve_positions(self, count):
+        # fetchall, not fetchone: the UPDATE only finishes once its RETURNING rows are read.
+        last = self.storage.fetchall(self.reserve_sql, (count, self.name))[0][0]
+        return range(last - count + 1, last + 1)
+
+    def _decode(self, row):
+        value = {}
+        for column, cell in zip(self.stored_columns, row):
+            if column not in self.columns:
+                continue
+            value[column] = json.loads(cell) if column in self.json_columns and cell is not None else cell
+        return self.record(**value)
+
+    def _encode(self, column, cell):
+        return json.dumps(cell) if column in self.json_columns and cell is not None else cell
+
+    def __getitem__(self, key):
+        row = self.storage.fetchone(self.select_one_sql, (key,))
+        if row is None:
+            raise KeyError(key)
+        return self._decode(row)
+
+    def _params(self, key, value):
+        return [key] + [self._encode(column, value.get(column)) for column in self.stored_columns[1:]]
+
+    def __setitem__(self, key, value):
+        params = self._params(key, value)
+        if self.ordered:
+            params += list(self._reserve_positions(1))
+        self.storage.execute(self.upsert_sql, params)
+
+    def update(self, other=(), **kwargs):
+        rows = [self._params(key, value) for key, value in dict(other, **kwargs).items()]
+        if self.ordered and rows:
+            for row, position in zip(rows, self._reserve_positions(len(rows))):
+                row.append(position)
+        with self.storage.connection() as conn:
+            conn.executemany(self.upsert_sql, rows)
+
+    def __delitem__(self, key):
+        if not self.storage.execute(self.delete_sql, (key,)):
+            raise KeyError(key)
+
+    def pop(self, key, *default):
+        # One statement reads and deletes the row, so of two concurrent pops only one gets it.
+        rows = self.storage.fetchall(self.pop_sql, (key,))
+        if not rows:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._decode(rows[0])
+
+    def position(self, key):
+        row = self.storage.fetchone(self.position_sql, (key,))
+        return row[0] if row else None
+
+    def positions(self):
+        return self.storage.fetchall(self.positions_sql)
+
+    def __contains__(self, key):
+        return self.storage.fetchone(self.exists_sql, (key,)) is not None
+
+    def __iter__(self):
+        return iter([row[0] for row in self.storage.fetchall(self.select_keys_sql)])
+
+    def __len__(self):
+        return self.storage.fetchone(self.count_sql)[0]
+
+    def values(self):
+        return [self._decode(row) for row in self.storage.fetchall(self.select_all_sql)]
+
+    def items(self):
+        return [(row[0], self._decode(row)) for row in self.storage.fetchall(self.select_all_sql)]
+
+
+def open_storage(url):
+    """Open ``memory`` or ``sqlite:<path>`` storage."""
+    if url == "memory":
+        return MemoryStorage()
+    if url.startswith("sqlite:"):
+        return SQLiteStorage(url[len("sqlite:"):])
+    raise ValueError(f"Unsupported storage URL: {url}")